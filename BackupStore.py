@@ -0,0 +1,138 @@
+import os
+import sys
+import zlib
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime
+import NFOPatch
+import NFOApply
+
+# ############## ABOUT THIS FILE #####################
+#
+# Keeps the originals of the NFOs that FixFromDB.py and TrimTitle.py change
+# (backupMode 'store', the default), instead of a .bak copy next to each one.
+#
+# Each run that changes anything saves the originals in one file in infoDir,
+# named for the tool and the time, eg NFO_backup 2025-01-31 20-15-00 FixFromDB.sqlite.
+# The originals are compressed, and NFOs with exactly the same contents are
+# only stored once. Nothing is added to the show folders for the media server
+# to find, and a later run never overwrites an earlier run's backups.
+#
+# UNDOING A RUN
+# To put every NFO a run changed back as it was before the run:
+#     python BackupStore.py "NFO_backup 2025-01-31 20-15-00 FixFromDB.sqlite"
+# or to put back just some of them, add their full paths after the file:
+#     python BackupStore.py "NFO_backup ... .sqlite" "c:\\tv\\Show\\s01e01.nfo"
+# Add --list to list what's in a backup file without putting anything back.
+# (If an NFO was changed more than once in one run, eg in watch mode, it is
+# put back as it was before the first change.)
+#
+# backupMode 'bak' makes .bak copies next to each NFO as earlier versions did
+# (overwriting any .bak already there), and 'none' keeps no backups at all.
+#
+# ###################################################
+
+# Open a backup store for this run of tool, in folder. The file isn't
+# created until the first original is saved. (Runs starting in the same
+# second, eg jobs in a Session - see NFOSession.py - get a number added.)
+
+def openStore(folder, tool):
+   name = 'NFO_backup ' + datetime.now().strftime("%Y-%m-%d %H-%M-%S") + ' ' + tool
+   path = folder + name + '.sqlite'
+   number = 1
+   while os.path.exists(path):
+      number += 1
+      path = folder + name + ' ' + str(number) + '.sqlite'
+   return {'path': path, 'conn': None, 'lock': threading.Lock(), 'saved': 0}
+
+def connect(path):
+   conn = sqlite3.connect(path, check_same_thread=False)
+   # each original is on disk before the NFO is replaced
+   conn.execute('PRAGMA journal_mode=WAL')
+   conn.execute('PRAGMA synchronous=FULL')
+   conn.execute('CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, data BLOB)')
+   conn.execute('CREATE TABLE IF NOT EXISTS files (seq INTEGER PRIMARY KEY, path TEXT, hash TEXT, saved TEXT)')
+   conn.execute('CREATE INDEX IF NOT EXISTS files_path ON files (path)')
+   return conn
+
+# Save the original contents (bytes) of the NFO at path. Safe to call from
+# the update threads.
+
+def saveOriginal(store, path, data):
+   contentHash = hashlib.sha256(data).hexdigest()
+   with store['lock']:
+      if store['conn'] is None:
+         store.update({'conn': connect(store['path'])})
+      conn = store['conn']
+      if conn.execute('SELECT 1 FROM blobs WHERE hash = ?', (contentHash,)).fetchone() is None:
+         conn.execute('INSERT INTO blobs VALUES (?, ?)', (contentHash, zlib.compress(data)))
+      conn.execute('INSERT INTO files (path, hash, saved) VALUES (?, ?, ?)', (str(path), contentHash, datetime.now().isoformat()))
+      conn.commit()
+      store['saved'] += 1
+
+# What patchNFO should do for backups under backupMode: True for .bak copies,
+# a function saving to store, or False for none.
+
+def backupMethod(mode, store):
+   if mode == 'bak':
+      return True
+   if mode == 'store':
+      return lambda path, data: saveOriginal(store, path, data)
+   return False
+
+def closeStore(store):
+   if store['conn'] is None:
+      return
+   with store['lock']:
+      store['conn'].close()
+   print("The originals of the NFOs changed are saved in " + store['path'] + ".")
+   print("To put them back, run: python BackupStore.py \"" + store['path'] + "\"")
+
+# The originals in a backup file, as {path: hash}, the first one saved for
+# each path. paths: only these (all if empty).
+
+def listOriginals(conn, paths=()):
+   originals = {}
+   for path, contentHash in conn.execute('SELECT path, hash FROM files ORDER BY seq'):
+      if (len(paths) > 0) and (path not in paths):
+         continue
+      if path not in originals:
+         originals.update({path: contentHash})
+   return originals
+
+# Put NFOs back as they were, workers at a time. Returns an NFOApply report.
+
+def restore(storePath, paths=(), workers=4):
+   conn = sqlite3.connect(storePath, check_same_thread=False)
+   lock = threading.Lock()
+   originals = listOriginals(conn, paths)
+   for path in paths:
+      if path not in originals:
+         print("No backup of " + path + " in " + storePath + ".")
+
+   def restoreOne(item):
+      with lock:
+         data = zlib.decompress(conn.execute('SELECT data FROM blobs WHERE hash = ?', (item['hash'],)).fetchone()[0])
+      NFOPatch.atomicWrite(item['path'], data)
+      return True
+
+   items = [{'path': path, 'hash': contentHash} for path, contentHash in originals.items()]
+   report = NFOApply.applyConcurrently(items, restoreOne, workers)
+   conn.close()
+   print(str(report['counts'].get(True, 0)) + " NFOs put back as they were.")
+   NFOApply.reportErrors(report)
+   return report
+
+if __name__ == '__main__':
+   if len(sys.argv) < 2:
+      print("Usage: python BackupStore.py <backup file> [--list] [NFO paths...]")
+      sys.exit()
+   myPaths = [arg for arg in sys.argv[2:] if arg != '--list']
+   if '--list' in sys.argv:
+      myConn = sqlite3.connect(sys.argv[1])
+      for myPath in listOriginals(myConn, myPaths):
+         print(myPath)
+      myConn.close()
+   else:
+      restore(sys.argv[1], myPaths)
@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import time
+import importlib
+import contextlib
+import types
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import NFOApply
+
+# ############## ABOUT THIS FILE #####################
+#
+# Runs FixFromDB.py and TrimTitle.py for many shows in one go, instead of
+# editing the user variables and running the script once per show. The shows
+# ("jobs") are listed in a batch file, each with its own settings, and are
+# run side by side, each in a process of its own.
+#
+# Run it with the batch file: python BatchRun.py shows.toml (or shows.json;
+# TOML needs Python 3.11 or later). A batch file looks like:
+#
+#   workers = 4        # most jobs running at once (default: one per CPU core)
+#   perVolume = 2      # most jobs running at once on any one share or drive
+#   infoDir = "c:\\nfo logs\\"  # each job's logs go in a folder in here
+#   args = ["--full"]  # options for every job, as on the command line (optional)
+#
+#   [settings]         # user variables shared by every job (optional; each
+#                      # job only takes the ones its tool has)
+#   searchMethod = 2
+#
+#   [[jobs]]
+#   name = "Forensic Files"
+#   tool = "FixFromDB"            # or "TrimTitle"
+#   [jobs.settings]               # this job's user variables
+#   showroot = "\\\\192.168.1.30\\tv\\Forensic Files"
+#   dataFile = "c:\\data\\forensic.csv"
+#   seasonPattern = "[Ss][0-9]+"
+#
+# or the same as JSON: {"workers": 4, "perVolume": 2, "infoDir": "...",
+# "settings": {...}, "jobs": [{"name": "...", "tool": "...", "settings": {...}}]}
+#
+# Settings use the same names as the user variables in the scripts. Unless a
+# job sets its own infoDir, it gets a folder named after it in the batch
+# infoDir, as jobs can't share one. Each job's output goes to BatchRun.log
+# in its infoDir, and a summary of every job (matched, skipped, updated,
+# failed) is printed at the end and saved as BatchRun_summary.json in the
+# batch infoDir.
+#
+# Nobody is there to answer questions while a batch runs, so fuzzy matches
+# (searchMethod 1) are reviewed with reviewMode 'auto': only matches scoring
+# autoAccept or more are accepted (see MatchReview.py). Run a show on its
+# own to review the rest, or use manualSave for a batch of update tables.
+#
+# ###################################################
+
+tools = ['FixFromDB', 'TrimTitle']
+
+def loadBatch(path):
+   if path.lower().endswith('.toml'):
+      import tomllib
+      with open(path, 'rb') as file:
+         batch = tomllib.load(file)
+   else:
+      with open(path, encoding='utf-8') as file:
+         batch = json.load(file)
+   # workers 0 (or not set) means one per CPU core; perVolume has to let at
+   # least one job run, or the batch would wait forever
+   workers = batch.get('workers', 0)
+   if (not isinstance(workers, int)) or isinstance(workers, bool):
+      raise ValueError("workers must be a whole number (0 for one per CPU core), please check the batch file.")
+   perVolume = batch.get('perVolume', 1)
+   if (not isinstance(perVolume, int)) or isinstance(perVolume, bool) or (perVolume < 1):
+      raise ValueError("perVolume must be a whole number, 1 or more, please check the batch file.")
+   return batch
+
+# Work out each job's full settings from the batch, and check them.
+
+def makeJobs(batch):
+   jobs = []
+   infoDirs = {}
+   for n, job in enumerate(batch.get('jobs', [])):
+      name = str(job.get('name', 'job ' + str(n + 1)))
+      tool = job.get('tool', 'FixFromDB')
+      if tool not in tools:
+         raise ValueError("Job '" + name + "' has an unknown tool '" + str(tool) + "', please use FixFromDB or TrimTitle.")
+      shared = dict(batch.get('settings', {}))
+      settings = dict(job.get('settings', {}))
+      if 'showroot' not in settings:
+         raise ValueError("Job '" + name + "' has no showroot, please check the batch file.")
+      if ('infoDir' not in settings) and ('infoDir' in shared):
+         raise ValueError("Jobs can't share an infoDir, please set infoDir for each job or for the batch as a whole.")
+      if 'infoDir' not in settings:
+         settings.update({'infoDir': os.path.join(batch.get('infoDir', ''), name) + os.sep})
+      if settings['infoDir'] in infoDirs:
+         raise ValueError("Jobs '" + infoDirs[settings['infoDir']] + "' and '" + name + "' have the same infoDir, please give each job its own.")
+      infoDirs.update({settings['infoDir']: name})
+      if tool == 'FixFromDB':
+         settings.update({'reviewMode': 'auto'})
+      jobs.append({'name': name, 'tool': tool, 'shared': shared, 'settings': settings, 'args': list(batch.get('args', [])) + list(job.get('args', [])),
+                   'volume': NFOApply.shareOf(settings['showroot'])})
+   return jobs
+
+# True if name is one of script's user variables (not a function or an
+# imported module, which a shared setting mustn't replace).
+
+def isSetting(script, name):
+   if not hasattr(script, name):
+      return False
+   value = getattr(script, name)
+   return not (callable(value) or isinstance(value, types.ModuleType))
+
+# Run one job (in a worker process). Returns its summary.
+
+def runJob(job):
+   started = time.time()
+   os.makedirs(job['settings']['infoDir'], exist_ok=True)
+   summary = {}
+   with open(job['settings']['infoDir'] + 'BatchRun.log', 'a', encoding='utf-8') as log:
+      with contextlib.redirect_stdout(log):
+         script = importlib.import_module(job['tool'])
+         script.configure({name: value for name, value in job['shared'].items() if isSetting(script, name)})
+         script.configure(job['settings'])
+         try:
+            summary.update(script.main([job['tool'] + '.py'] + job['args']))
+         except SystemExit:
+            # the script stopped itself, eg after a manualSave or with an unfinished journal
+            summary.update(script.runSummary)
+            summary.update({'note': 'stopped early, see BatchRun.log'})
+   summary.update({'seconds': round(time.time() - started, 1)})
+   return summary
+
+# Run every job, at most workers at once and at most perVolume at once on
+# any one share or drive. Returns a list of (job, summary).
+
+def runBatch(jobs, workers=0, perVolume=1):
+   if workers < 1:
+      workers = os.cpu_count() or 1
+   waiting = list(jobs)
+   running = {}
+   results = []
+   # a fresh process for each job, so no settings carry over from the last one
+   with ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=1) as pool:
+      while waiting or running:
+         for job in list(waiting):
+            if len(running) >= workers:
+               break
+            if sum(1 for other in running.values() if other['volume'] == job['volume']) >= perVolume:
+               continue
+            waiting.remove(job)
+            running.update({pool.submit(runJob, job): job})
+            print("Started " + job['name'] + " (" + job['tool'] + ")")
+         for future in wait(running, return_when=FIRST_COMPLETED)[0]:
+            job = running.pop(future)
+            try:
+               summary = future.result()
+            except Exception as error:
+               summary = {'error': type(error).__name__ + ": " + str(error)}
+            results.append((job, summary))
+            print("Finished " + job['name'] + ("" if 'error' not in summary else " with an error"))
+   return results
+
+def reportBatch(results, folder=''):
+   print("\n" + "JOB".ljust(30) + "TOOL".ljust(11) + "MATCHED".rjust(9) + "SKIPPED".rjust(9) + "UPDATED".rjust(9) + "FAILED".rjust(8))
+   totals = {'matched': 0, 'skipped': 0, 'updated': 0, 'failed': 0}
+   for job, summary in results:
+      line = job['name'][:29].ljust(30) + job['tool'].ljust(11)
+      for key in totals:
+         totals[key] += summary.get(key, 0)
+         line += str(summary.get(key, 0)).rjust(9 if key != 'failed' else 8)
+      if 'error' in summary:
+         line += "  " + summary['error']
+      elif 'note' in summary:
+         line += "  " + summary['note']
+      print(line)
+   print("TOTAL".ljust(41) + "".join(str(totals[key]).rjust(9 if key != 'failed' else 8) for key in totals))
+   destFile = os.path.join(folder, 'BatchRun_summary.json')
+   with open(destFile, 'w', encoding='utf-8') as file:
+      json.dump([{'name': job['name'], 'tool': job['tool'], 'infoDir': job['settings']['infoDir'], 'summary': summary}
+                 for job, summary in results], file, indent=1)
+   print("\nThe summary is saved at " + destFile + ".")
+
+if __name__ == '__main__':
+   if len(sys.argv) < 2:
+      print("Usage: python BatchRun.py <batch file (.toml or .json)>")
+      sys.exit()
+   batch = loadBatch(sys.argv[1])
+   jobs = makeJobs(batch)
+   results = runBatch(jobs, batch.get('workers', 0), batch.get('perVolume', 1))
+   reportBatch(results, batch.get('infoDir', ''))
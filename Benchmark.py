@@ -0,0 +1,299 @@
+import os
+import io
+import sys
+import csv
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import statistics
+import contextlib
+import subprocess
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import NFOCache
+import NFOTransform
+import BackupStore
+
+# ############## ABOUT THIS FILE #####################
+#
+# Times the main steps of FixFromDB.py and TrimTitle.py on made-up show
+# libraries of different sizes, so changes that speed them up (or slow them
+# down) can be measured. Run it with: python Benchmark.py
+#
+# For each size in librarySizes (shows x episodes per show), a library is
+# written to each folder in storageDirs: a folder per show with season
+# folders of realistic episode NFOs (cast, stream details, plot), a CSV of
+# the episodes for each show, and filenames with the sort of noise fuzzy
+# matching has to cope with (typos, dropped punctuation, odd capitals, a
+# resolution tag). The same sizes always give the same library.
+#
+# Each step in benchSteps is then timed on its own, repeats times, each time
+# in a fresh process (so nothing carries over, as with BatchRun.py). As in
+# BatchRun.py, each show is done as a run of its own, and the time for a
+# step is the total over all the shows. The steps are:
+#   makeNFOlist-1 / makeNFOlist-2   scanning and cleaning filenames (searchMethod 1 / 2)
+#   makeEpisodeList                 reading the CSV (useCatalog 0)
+#   compareData-1 / compareData-2   matching titles / episode numbers
+#   nfoEdits                        updating every matched NFO (searchMethod 2)
+#   nfoTrim                         TrimTitle.py's update
+# The update steps change the NFOs, so the library is written again before
+# each of their runs. The files will usually still be in memory from being
+# written, so reading them costs less than it would on a cold start.
+#
+# The results are printed and saved to <date time>_Benchmark.json in
+# resultsDir, with the best and median time of each step, the version (git
+# commit) and the machine details. To compare two results files (eg, from
+# before and after a change):
+#     python Benchmark.py --compare old_Benchmark.json new_Benchmark.json
+#
+# ###################################################
+
+# ################ USER VARIABLES HERE ###############
+
+# librarySizes: (shows, episodes per show) for each library to time.
+# storageDirs:  Folders to write the libraries in; each size is timed in each.
+#                 '/dev/shm/' is in memory (tmpfs) on Linux; '' is the current
+#                 folder (normally a regular disk). Folders that don't exist
+#                 are skipped. Everything written is deleted afterwards.
+# benchSteps:   Which steps to time (see above).
+# repeats:      How many times to time each step.
+# resultsDir:   Where to save the results (include trailing \, \\ when escaped).
+
+librarySizes = [(1, 100), (10, 100), (20, 500)]
+storageDirs = ['/dev/shm/', '']
+benchSteps = ['makeNFOlist-1', 'makeNFOlist-2', 'makeEpisodeList', 'compareData-1', 'compareData-2', 'nfoEdits', 'nfoTrim']
+repeats = 3
+resultsDir = ""
+
+# ###################################################
+
+words = ['river', 'night', 'return', 'doctor', 'blue', 'house', 'final', 'part', 'secret', 'garden', 'storm', 'silver',
+         'broken', 'promise', 'winter', 'shadow', 'letter', 'island', 'stranger', 'fire', 'summer', 'lost', 'key', 'last',
+         'train', 'mirror', 'crown', 'hunter', 'stone', 'bridge', 'ghost', 'long', 'road', 'home', 'city', 'dark', 'water',
+         'heart', 'wolf', 'queen', 'king', 'empty', 'room', 'first', 'light', 'old', 'friend', 'cold', 'case', 'bad', 'blood']
+resolutions = [' (480p)', ' (720p)', ' (1080p)', '']
+seasonLength = 20
+
+def makeTitle(rng, used):
+   while True:
+      title = ' '.join(rng.choice(words) for n in range(rng.randint(2, 5))).title()
+      if rng.random() < 0.2:
+         title = 'The ' + title
+      if title not in used:
+         used.add(title)
+         return title
+
+# The title as it might appear in a filename: typos, lost punctuation, odd capitals.
+
+def noisyTitle(rng, title):
+   noisy = list(title)
+   for n in range(rng.randint(0, 2)):
+      pos = rng.randrange(len(noisy))
+      change = rng.random()
+      if change < 0.4:
+         del noisy[pos]
+      elif change < 0.7:
+         noisy.insert(pos, noisy[pos])
+      else:
+         noisy[pos] = rng.choice('abcdefghijklmnopqrstuvwxyz')
+   noisy = ''.join(noisy)
+   if rng.random() < 0.3:
+      noisy = noisy.lower()
+   return noisy.replace('The ', '') if rng.random() < 0.2 else noisy
+
+def makeNFO(rng, title, season, episode, year):
+   actors = ''.join('  <actor>\n    <name>' + ' '.join(rng.choice(words).title() for n in range(2)) + '</name>\n    <role>'
+                    + rng.choice(words).title() + '</role>\n    <type>Actor</type>\n  </actor>\n' for n in range(rng.randint(3, 8)))
+   return ('<?xml version="1.0" encoding="utf-8" standalone="yes"?>\n<episodedetails>\n  <plot />\n'
+           '  <lockdata>false</lockdata>\n  <dateadded>2024-01-0' + str(rng.randint(1, 9)) + ' 10:00:00</dateadded>\n'
+           '  <title>' + title.lower() + '</title>\n' + actors + '  <year>' + str(year) + '</year>\n'
+           '  <runtime>' + str(rng.randint(20, 60)) + '</runtime>\n  <season>' + str(season) + '</season>\n'
+           '  <episode>' + str(episode) + '</episode>\n  <fileinfo>\n    <streamdetails>\n      <video>\n'
+           '        <codec>h264</codec>\n        <width>1280</width>\n        <height>720</height>\n'
+           '        <durationinseconds>' + str(rng.randint(1200, 3600)) + '</durationinseconds>\n      </video>\n'
+           '      <audio>\n        <codec>aac</codec>\n        <channels>2</channels>\n      </audio>\n'
+           '    </streamdetails>\n  </fileinfo>\n</episodedetails>\n')
+
+# Write a library of shows x episodes in folder: a folder per show (Show 001
+# and so on) and a CSV per show (Show 001.csv). Returns the show names.
+
+def makeLibrary(folder, shows, episodes, seed=1):
+   rng = random.Random(seed)
+   names = []
+   for show in range(shows):
+      name = 'Show ' + str(show + 1).zfill(3)
+      names.append(name)
+      used = set()
+      year = rng.randint(1970, 2020)
+      with open(os.path.join(folder, name + '.csv'), 'w', newline='', encoding='utf-8') as csvFile:
+         writer = csv.writer(csvFile)
+         writer.writerow(['0', '1', '2', '3', '4'])
+         for n in range(episodes):
+            season = n // seasonLength + 1
+            episode = n % seasonLength + 1
+            title = makeTitle(rng, used)
+            plot = ' '.join(rng.choice(words) for i in range(rng.randint(20, 60))).capitalize() + '.'
+            writer.writerow([season, episode, title, plot, year + season - 1])
+            seasonDir = os.path.join(folder, name, 'Season ' + str(season))
+            os.makedirs(seasonDir, exist_ok=True)
+            filename = (name + ' s' + str(season).zfill(2) + 'e' + str(episode).zfill(2) + ' '
+                        + noisyTitle(rng, title) + rng.choice(resolutions) + '.nfo')
+            with open(os.path.join(seasonDir, filename), 'w', encoding='utf-8') as nfo:
+               nfo.write(makeNFO(rng, title, season, episode, year + season - 1))
+   return names
+
+# The settings for FixFromDB.py / TrimTitle.py for one show of a library.
+
+def showSettings(case, name):
+   return {'showroot': os.path.join(case['library'], name), 'infoDir': case['infoDir'], 'incrementalRun': 0}
+
+def fixSettings(case, name, method):
+   settings = showSettings(case, name)
+   settings.update({'searchMethod': method, 'dataFile': os.path.join(case['library'], name + '.csv'), 'useCatalog': 0, 'useJournal': 0,
+                    'useDiskCache': 0, 'yearColumn': 4, 'fileFilter1': name + ' [Ss][0-9]+[Ee][0-9]+ ',
+                    'fileFilter2': ' \\([0-9]+p\\)'})
+   return settings
+
+# Time one step over every show in the library. Runs in a process of its own.
+
+def runStep(case):
+   import FixFromDB
+   import TrimTitle
+   step = case['step']
+   # the update is timed on episode number matches, which need no review
+   method = 1 if step.endswith('-1') else 2
+   total = 0
+   with contextlib.redirect_stdout(io.StringIO()):
+      store = BackupStore.openStore(case['infoDir'], 'Benchmark')
+      for name in case['shows']:
+         if step == 'nfoTrim':
+            TrimTitle.configure(showSettings(case, name))
+            TrimTitle.configure({'fileFilter1': name + ' [Ss][0-9]+[Ee][0-9]+ '})
+            TrimTitle.nfoData.clear()
+            TrimTitle.editor = NFOTransform.openEngine(TrimTitle.makeTransforms(), TrimTitle.nfoCache, BackupStore.backupMethod('store', store))
+            TrimTitle.makeNFOTrimList(TrimTitle.showroot, '.nfo')
+            started = time.perf_counter()
+            TrimTitle.nfoTrim(TrimTitle.nfoData)
+            total += time.perf_counter() - started
+            continue
+         FixFromDB.configure(fixSettings(case, name, method))
+         for data in [FixFromDB.nfoData, FixFromDB.userData, FixFromDB.matchList]:
+            data.clear()
+         FixFromDB.nfoCache = NFOCache.openCache(FixFromDB.cacheBudgetMB)
+         started = time.perf_counter()
+         if step.startswith('makeNFOlist'):
+            FixFromDB.makeNFOlist(FixFromDB.showroot, '.nfo', method)
+         elif step == 'makeEpisodeList':
+            FixFromDB.makeEpisodeList(FixFromDB.dataFile)
+         else:
+            FixFromDB.makeNFOlist(FixFromDB.showroot, '.nfo', method)
+            FixFromDB.makeEpisodeList(FixFromDB.dataFile)
+            if step == 'nfoEdits':
+               FixFromDB.compareData(FixFromDB.nfoData, FixFromDB.userData, method)
+               FixFromDB.editor = NFOTransform.openEngine(FixFromDB.makeTransforms(), FixFromDB.nfoCache,
+                                                          BackupStore.backupMethod('store', store))
+            started = time.perf_counter()
+            if step == 'nfoEdits':
+               FixFromDB.nfoEdits(FixFromDB.matchList)
+            else:
+               FixFromDB.compareData(FixFromDB.nfoData, FixFromDB.userData, method)
+         total += time.perf_counter() - started
+         NFOCache.closeCache(FixFromDB.nfoCache)
+      BackupStore.closeStore(store)
+   return total
+
+# The type of file system folder is on (eg tmpfs, ext4), where that can be
+# found out (Linux only), or ''.
+
+def fileSystem(folder):
+   path = os.path.realpath(folder)
+   found = ('', '')
+   try:
+      with open('/proc/mounts') as mounts:
+         for line in mounts:
+            parts = line.split()
+            mountPoint = parts[1].replace('\\040', ' ')
+            if (path == mountPoint or path.startswith(mountPoint.rstrip('/') + '/')) and (len(mountPoint) > len(found[0])):
+               found = (mountPoint, parts[2])
+   except OSError:
+      pass
+   return found[1]
+
+def version():
+   try:
+      return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True).stdout.strip()
+   except OSError:
+      return ''
+
+# Time every step at every size in every storage folder. Returns the results
+# as saved to the results file.
+
+def runBenchmark():
+   results = {'version': version(), 'started': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+              'platform': platform.platform(), 'cpus': os.cpu_count(), 'repeats': repeats, 'cases': []}
+   for storage in storageDirs:
+      if (storage != '') and not os.path.isdir(storage):
+         print("Skipping " + storage + ", it doesn't exist.")
+         continue
+      work = tempfile.mkdtemp(prefix='NFO_benchmark_', dir=storage or '.')
+      try:
+         for shows, episodes in librarySizes:
+            case = {'library': os.path.join(work, 'library'), 'infoDir': os.path.join(work, 'info') + os.sep}
+            for step in benchSteps:
+               times = []
+               for n in range(repeats):
+                  if (n == 0) or (step in ['nfoEdits', 'nfoTrim']):
+                     for folder in [case['library'], case['infoDir']]:
+                        shutil.rmtree(folder, ignore_errors=True)
+                        os.makedirs(folder)
+                     case.update({'shows': makeLibrary(case['library'], shows, episodes)})
+                  case.update({'step': step})
+                  # a fresh process for each run, so nothing is left over from the last one
+                  with ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as pool:
+                     times.append(pool.submit(runStep, case).result())
+               entry = {'step': step, 'shows': shows, 'episodes': episodes, 'nfos': shows * episodes, 'storage': storage or os.getcwd(),
+                        'fileSystem': fileSystem(work), 'times': [round(t, 4) for t in times], 'best': round(min(times), 4),
+                        'median': round(statistics.median(times), 4)}
+               results['cases'].append(entry)
+               print(step.ljust(17) + (str(shows) + 'x' + str(episodes)).rjust(9) + (entry['fileSystem'] or entry['storage']).rjust(8)
+                     + ("%.3fs" % entry['best']).rjust(11) + ("%.3fs" % entry['median']).rjust(11))
+      finally:
+         shutil.rmtree(work, ignore_errors=True)
+   destFile = resultsDir + datetime.now().strftime("%Y-%m-%d %H-%M-%S") + "_Benchmark.json"
+   with open(destFile, 'w', encoding='utf-8') as file:
+      json.dump(results, file, indent=1)
+   print("\nThe results are saved at " + destFile + ".")
+   return results
+
+# Print the best times of two results files side by side. Steps more than
+# 10% slower in the second are flagged.
+
+def compareResults(oldPath, newPath):
+   with open(oldPath, encoding='utf-8') as file:
+      old = json.load(file)
+   with open(newPath, encoding='utf-8') as file:
+      new = json.load(file)
+   oldCases = {(ea['step'], ea['shows'], ea['episodes'], ea['fileSystem'] or ea['storage']): ea for ea in old['cases']}
+   print("STEP".ljust(17) + "SIZE".rjust(9) + "FS".rjust(8) + str(old['version'] or 'OLD').rjust(11) + str(new['version'] or 'NEW').rjust(11) + "CHANGE".rjust(9))
+   for ea in new['cases']:
+      key = (ea['step'], ea['shows'], ea['episodes'], ea['fileSystem'] or ea['storage'])
+      if key not in oldCases:
+         continue
+      before = oldCases[key]['best']
+      change = (ea['best'] - before) / before * 100 if before > 0 else 0
+      print(ea['step'].ljust(17) + (str(ea['shows']) + 'x' + str(ea['episodes'])).rjust(9) + key[3][-7:].rjust(8)
+            + ("%.3fs" % before).rjust(11) + ("%.3fs" % ea['best']).rjust(11) + ("%+.0f%%" % change).rjust(9) + ("  SLOWER" if change > 10 else ""))
+
+if __name__ == '__main__':
+   if '--compare' in sys.argv:
+      if len(sys.argv) < 4:
+         print("Usage: python Benchmark.py --compare <old results> <new results>")
+         sys.exit()
+      compareResults(sys.argv[2], sys.argv[3])
+   else:
+      print("STEP".ljust(17) + "SIZE".rjust(9) + "FS".rjust(8) + "BEST".rjust(11) + "MEDIAN".rjust(11))
+      runBenchmark()
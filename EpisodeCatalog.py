@@ -0,0 +1,255 @@
+import os
+import csv
+import json
+import sqlite3
+import threading
+import MatchTools
+import RunManifest
+
+# ############## ABOUT THIS FILE #####################
+#
+# Keeps the episode data from your CSV (dataFile in FixFromDB.py) in a small
+# SQLite database (NFO_catalog.sqlite in infoDir), so a big CSV - eg, one
+# export covering hundreds of shows - isn't read into memory on every run.
+#
+# The CSV is imported with the same numbered column settings as before
+# (seasonColumn, titleColumn, etc). It is only imported again when the CSV
+# (or the column settings) change; otherwise the catalog from last time is
+# used as it is. Run FixFromDB.py --import-catalog to import it without
+# doing anything else.
+#
+# While matching, rows are looked up as needed rather than all held at once:
+# - method 1 loads just the titles (and only the show's, with showColumn and
+#   showName set), and fetches the rest of a row once it's matched;
+# - method 2 looks each NFO's key up in an index of the tidied-up keys (see
+#   normaliseKey in MatchTools.py), with the season/episode, IMDB id and
+#   TVDB id columns indexed as well.
+#
+# TITLE SEARCH
+# Titles are also indexed by SQLite's full text search in 3-character chunks
+# ("trigrams"). With useTitleIndex set to 2, each NFO is only scored against
+# the catalogLimit titles that share the most chunks with it. This is the
+# quickest option for very big catalogs, but unlike useTitleIndex 1 it isn't
+# guaranteed to find the same best match as a full comparison. It needs
+# SQLite 3.34 or later (included with recent Python versions); with older
+# versions useTitleIndex 1 is used instead.
+#
+# ###################################################
+
+catalogFile = 'NFO_catalog.sqlite'
+catalogFields = ['show', 'season', 'episode', 'title', 'plot', 'year', 'runtime', 'imdbid', 'tvdbid', 'absolute', 'airdate']
+
+def tableExists(conn, name):
+   return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone() is not None
+
+def readMeta(conn):
+   if not tableExists(conn, 'meta'):
+      return {}
+   return dict(conn.execute('SELECT name, value FROM meta').fetchall())
+
+def writeMeta(conn, meta):
+   conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+   for name, value in meta.items():
+      conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (name, str(value)))
+
+# Rows of the CSV as [id, values in catalogFields order], read a row at a
+# time. mapping gives the CSV column for each field the CSV has.
+
+def readRows(csvPath, mapping):
+   with open(csvPath, newline='') as csvfile:
+      reader = csv.DictReader(csvfile)
+      for id, row in enumerate(reader):
+         yield [id] + [(row[str(mapping[field])] if field in mapping else None) for field in catalogFields]
+
+def columnMapping(columns):
+   mapping = {}
+   for ea in columns:
+      for key, value in ea.items():
+         if value != 'NA':
+            mapping.update({key: value})
+   return mapping
+
+# Build the catalog tables from scratch.
+
+def buildCatalog(conn, csvPath, mapping):
+   for table in ['titles', 'keys', 'episodes', 'meta']:
+      conn.execute('DROP TABLE IF EXISTS ' + table)
+   conn.execute('CREATE TABLE episodes (id INTEGER PRIMARY KEY, ' + ', '.join(field + ' TEXT' for field in catalogFields) + ')')
+   conn.executemany('INSERT INTO episodes VALUES (' + ', '.join('?' * (len(catalogFields) + 1)) + ')', readRows(csvPath, mapping))
+   conn.execute('CREATE INDEX episodes_number ON episodes (show, season, episode)')
+   for field in ['imdbid', 'tvdbid', 'absolute', 'airdate']:
+      conn.execute('CREATE INDEX episodes_' + field + ' ON episodes (' + field + ')')
+   # tidied-up match keys for method 2, for every matchKey the columns allow
+   conn.execute('CREATE TABLE keys (keyType TEXT, key TEXT, show TEXT, id INTEGER)')
+   for keyType, fields in MatchTools.keyFields.items():
+      if not all(field in mapping for field in fields):
+         continue
+      rows = conn.execute('SELECT id, show, ' + ', '.join(fields) + ' FROM episodes')
+      keys = ((keyType, '\t'.join(key), row[1], row[0]) for row in rows for key in [MatchTools.normaliseKey(keyType, row[2:])] if key is not None)
+      conn.executemany('INSERT INTO keys VALUES (?, ?, ?, ?)', list(keys))
+   conn.execute('CREATE INDEX keys_key ON keys (keyType, key)')
+   titleSearch = 1
+   try:
+      conn.execute("CREATE VIRTUAL TABLE titles USING fts5(title, content='episodes', content_rowid='id', tokenize='trigram')")
+      conn.execute("INSERT INTO titles(titles) VALUES ('rebuild')")
+   except sqlite3.OperationalError:
+      titleSearch = 0
+   return titleSearch
+
+# Open the catalog in folder, importing the CSV first if it has changed since
+# the last import (or force is 1). columns is the catalogColumns list from
+# FixFromDB.py. The CSV is only hashed if its size or modified time changed.
+
+def openCatalog(csvPath, folder, columns, force=0):
+   conn = sqlite3.connect(folder + catalogFile, check_same_thread=False)
+   mapping = columnMapping(columns)
+   meta = readMeta(conn)
+   stamp = csvStamp(csvPath)
+   columnVersion = json.dumps(mapping, sort_keys=True)
+   rebuild = (force == 1) or (meta.get('columns') != columnVersion) or (meta.get('csvPath') != csvPath)
+   csvHash = meta.get('csvHash')
+   if (not rebuild) and (meta.get('stamp') != stamp):
+      csvHash = RunManifest.hashFile(csvPath)
+      rebuild = csvHash != meta.get('csvHash')
+   if rebuild:
+      print("Importing " + csvPath + " into the episode catalog...")
+      titleSearch = buildCatalog(conn, csvPath, mapping)
+      csvHash = RunManifest.hashFile(csvPath)
+      meta = {'columns': columnVersion, 'csvPath': csvPath, 'titleSearch': titleSearch}
+   meta.update({'stamp': stamp, 'csvHash': csvHash})
+   writeMeta(conn, meta)
+   conn.commit()
+   count = conn.execute('SELECT count(*) FROM episodes').fetchone()[0]
+   if rebuild:
+      print(str(count) + " episodes imported.")
+   return {'conn': conn, 'fields': ['id'] + [field for field in catalogFields if field in mapping],
+           'titleSearch': str(meta['titleSearch']) == '1', 'count': count}
+
+def closeCatalog(catalog):
+   catalog['conn'].close()
+
+def csvStamp(csvPath):
+   stat = os.stat(csvPath)
+   return str(stat.st_size) + ':' + str(stat.st_mtime_ns)
+
+# The CSV's hash (for incrementalRun, see RunManifest.py). If the catalog in
+# folder was last imported from this CSV and its size and modified time
+# haven't changed since, the hash saved then is used instead of reading the
+# whole CSV again.
+
+def csvHash(csvPath, folder):
+   if os.path.exists(folder + catalogFile):
+      conn = sqlite3.connect(folder + catalogFile)
+      try:
+         meta = readMeta(conn)
+      finally:
+         conn.close()
+      if (meta.get('csvPath') == csvPath) and (meta.get('stamp') == csvStamp(csvPath)) and meta.get('csvHash'):
+         return meta['csvHash']
+   return RunManifest.hashFile(csvPath)
+
+# The catalog, or the rows for one show, as a read-only list of episode dicts
+# (the same dicts makeEpisodeList builds). Rows are fetched from the catalog
+# when asked for, by their id (their position in the CSV), so this can be used
+# in place of userData without loading the catalog into memory.
+
+class CatalogView:
+   def __init__(self, catalog, show=''):
+      self.catalog = catalog
+      self.conn = catalog['conn']
+      self.show = show
+      self.lock = threading.Lock()
+      self.select = 'SELECT ' + ', '.join(catalog['fields']) + ' FROM episodes'
+      self.where = ''
+      self.params = ()
+      if show != '':
+         self.where = ' WHERE show = ?'
+         self.params = (show,)
+
+   # Every use of the connection holds the lock, as rows are looked up from
+   # the update threads (and matching can be going on at the same time, in
+   # streamMode).
+
+   def fetchAll(self, sql, params=()):
+      with self.lock:
+         return self.conn.execute(sql, params).fetchall()
+
+   def makeRow(self, row):
+      entry = {}
+      for field, value in zip(self.catalog['fields'], row):
+         entry.update({field: value})
+      return entry
+
+   def __getitem__(self, id):
+      rows = self.fetchAll(self.select + ' WHERE id = ?', (id,))
+      if len(rows) == 0:
+         raise IndexError(id)
+      return self.makeRow(rows[0])
+
+   def __iter__(self):
+      # a few hundred rows at a time, without holding the lock in between
+      with self.lock:
+         cursor = self.conn.execute(self.select + self.where + ' ORDER BY id', self.params)
+      while True:
+         with self.lock:
+            rows = cursor.fetchmany(500)
+         if len(rows) == 0:
+            return
+         for row in rows:
+            yield self.makeRow(row)
+
+   def __len__(self):
+      return self.fetchAll('SELECT count(*) FROM episodes' + self.where, self.params)[0][0]
+
+   # (id, title) of every episode, for building a matcher.
+
+   def titles(self):
+      return self.fetchAll('SELECT id, title FROM episodes' + self.where + ' ORDER BY id', self.params)
+
+   # Check the catalog has the columns for matchKey keyType.
+
+   def checkKey(self, keyType):
+      if keyType not in MatchTools.keyFields:
+         raise ValueError("Not a valid matchKey, please check user variables and try again.")
+      for field in MatchTools.keyFields[keyType]:
+         if field not in self.catalog['fields']:
+            raise ValueError("matchKey '" + keyType + "' needs a " + field + " column in your CSV, please check user variables and try again.")
+
+   # Ids of the rows with this key (a tuple from normaliseKey).
+
+   def findKey(self, keyType, key):
+      query = 'SELECT id FROM keys WHERE keyType = ? AND key = ?'
+      params = (keyType, '\t'.join(key))
+      if self.show != '':
+         query += ' AND show = ?'
+         params += (self.show,)
+      return [row[0] for row in self.fetchAll(query + ' ORDER BY id', params)]
+
+   # Keys on more than one row, in the form makeKeyIndex gives them.
+
+   def duplicateKeys(self, keyType):
+      self.checkKey(keyType)
+      query = 'SELECT key, group_concat(id) FROM keys WHERE keyType = ?'
+      params = (keyType,)
+      if self.show != '':
+         query += ' AND show = ?'
+         params += (self.show,)
+      duplicates = {}
+      for key, ids in self.fetchAll(query + ' GROUP BY key HAVING count(*) > 1', params):
+         duplicates.update({tuple(key.split('\t')): sorted(int(id) for id in ids.split(','))})
+      return duplicates
+
+   # Ids and titles of up to limit episodes sharing the most 3-character
+   # chunks with term, best first (useTitleIndex 2).
+
+   def titleCandidates(self, term, limit=50):
+      grams = set(term[i:i + 3] for i in range(len(term) - 2))
+      if len(grams) == 0:
+         return []
+      query = ' OR '.join('"' + gram.replace('"', '""') + '"' for gram in grams)
+      sql = 'SELECT episodes.id, episodes.title FROM titles JOIN episodes ON episodes.id = titles.rowid WHERE titles MATCH ?'
+      params = (query,)
+      if self.show != '':
+         sql += ' AND episodes.show = ?'
+         params += (self.show,)
+      return self.fetchAll(sql + ' ORDER BY titles.rank LIMIT ?', params + (limit,))
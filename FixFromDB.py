@@ -1,11 +1,19 @@
 import os
 import sys
-import xml.etree.ElementTree as ET
-from fuzzywuzzy import fuzz
 import re
 import csv
-import shutil
 from datetime import datetime
+import MatchTools
+import NFOScanner
+import RunManifest
+import RunJournal
+import NFOCache
+import EpisodeCatalog
+import MatchReview
+import NFOWatch
+import BackupStore
+import NFOTransform
+import RunMetrics
 
 # ############## ABOUT THIS SCRIPT #####################
 #
@@ -36,26 +44,35 @@ from datetime import datetime
 #
 # METHOD ONE: FUZZY MATCHING EPISODE TITLES
 # For episode titles (fuzzy match), the user is asked to approve
-# each match. If approved, NFO is updated (original saved as *.bak). If
+# each match. If approved, NFO is updated (original backed up). If
 # declined, the failed match is logged for user to do manual checking
-# later.
+# later. By default, the matches are reviewed a page at a time, with the
+# most certain and least certain approved or refused automatically (see
+# REVIEWING FUZZY MATCHES below and MatchReview.py).
 #
 # METHOD TWO: EPISODE NUMBER MATCHING
 # Numerical episode/season matches are applied, normally without a confirm
-# step (but see below for exception). Original saves as *.bak,
+# step (but see below for exception). Originals are backed up,
 # and season.nfo and tvshow.nfo are excluded.
 #
-# .BAK BACKUP FILES
-# Be aware that there is no provision at this stage for preserving existing .bak
-# files. If there are existing .bak files, from an earlier run of this script
-# or for some other reason, they will be overwritten. You will need to rename
-# them or move them out to preserve them (or edit the function nfoEdits to give
-# the new backups a different file extension).
+# BACKUPS
+# NFOs that already have the right values are not rewritten or backed up.
+# The originals of the NFOs that are changed are saved, compressed, in one
+# backup file per run in infoDir (NFO_backup <date time> FixFromDB.sqlite), and
+# the whole run (or just some NFOs) can be put back with BackupStore.py - see
+# backupMode below and BackupStore.py. With backupMode 'bak', a .bak copy is
+# made next to each NFO instead, as in earlier versions; existing .bak files
+# are overwritten, so rename or move them out first to keep them.
 #
 # LOCKDATA FLAG
 # In both cases, the NFO file is also set to <lockdata>true</lockdata> -
 # in systems that respect this tag, such as Jellyfin, the alteration will not be
-# overwritten by metadata refreshes.
+# overwritten by metadata refreshes. (Set setLockdata to 0 to leave it alone.)
+#
+# TRIMMING TITLES AS WELL
+# With trimTitles set to 1, the title is also set from the NFO's filename, as
+# TrimTitle.py does, in the same pass: each NFO is read, backed up and written
+# once, rather than once by each tool. See NFOTransform.py.
 #
 # OPTIONAL FINAL MANUAL CHECK/EDITS
 # There may be cases where you wish to manually edit the changes before they are
@@ -70,6 +87,8 @@ from datetime import datetime
 # Then edit manualResume and resumeFile below to pull in your edits.
 # (Note that no QA is done on your edits, they are at your own risk).
 # The script will then proceed using your edited version of the update table.
+# (To finish a run that was interrupted while updating NFOs, use journalResume
+# instead - see RunJournal.py.)
 #
 # ORPHANED INCORRECT THUMBNAILS
 # You may be left with pre-existing incorrect thumbnails in some cases
@@ -94,6 +113,45 @@ from datetime import datetime
 # searchMethod:   Set to 1 to exclude (filter out) unwanted patterns
 #                 or 2 to include (filter in) desired patterns. Generally if you are
 #                 matching by episode name, you will want 1, and by episode number, 2.
+# excludeDirs:    Folders under showroot to leave out entirely, eg extras or backup
+#                 folders. Wildcards like '*backup*' match folder names; rules starting
+#                 're:' are regexes for the folder path. See NFOScanner.py.
+#                 season.nfo and tvshow.nfo are always left out.
+# streamMode:     Set to 1 to pass each NFO straight through matching, approval, logging
+#                 and editing as the folders are scanned, instead of finishing each
+#                 step for the whole show before starting the next. Memory use stays
+#                 flat, so a whole library can be done in one run. The logs are the
+#                 same. (Not used with manualResume.)
+# streamBuffer:   In streamMode, how many NFOs are matched at a time.
+# applyWorkers:   How many NFOs to update at once. Much faster on network shares;
+#                 1 updates them one at a time. See NFOApply.py.
+# applyShareLimit: Most NFOs to update at once on any one share or drive.
+# applyRetries:   How many times to retry an NFO that fails with a network error.
+# incrementalRun: Set to 1 to only look at NFOs that are new or have changed since they
+#                 were last fixed (or everything, if the CSV or settings have changed).
+#                 The record is kept in infoDir. See RunManifest.py.
+# fullRun:        Set to 1 (or run with --full) to look at every NFO this time anyway.
+# useJournal:     Set to 1 to keep a journal of the NFO updates in infoDir, so an
+#                 interrupted run can be finished with journalResume. See RunJournal.py.
+# journalResume:  Set to 1 (or run with --resume) to finish the NFO updates left over
+#                 from an interrupted run, and nothing else. (Be sure to change back to 0.)
+# cacheBudgetMB:  How much memory (roughly, in MB) to use keeping NFOs that have been read
+#                 once, so later steps don't read them again. See NFOCache.py.
+# useDiskCache:   Set to 1 to also save the NFO fields that were read to a cache in
+#                 infoDir, so later runs don't need to open unchanged NFOs to read them.
+# watchDelay:     Run with --watch to keep running and fix NFOs as they are added or
+#                 changed (see NFOWatch.py). Changes are collected until there have
+#                 been none for this many seconds, then done together.
+# watchPolling:   Set to 1 to check for changes by scanning the folder every
+#                 watchPollInterval seconds rather than being told of them (needs the
+#                 watchdog package; scanning is used anyway without it). Best for
+#                 network shares.
+# backupMode:     'store' to save the originals of the NFOs changed in one compressed
+#                 backup file per run in infoDir, which BackupStore.py can put back;
+#                 'bak' for a .bak copy next to each NFO; 'none' for no backups.
+# collectMetrics: Set to 1 to time each step of the run (scan, load, match, review, log,
+#                 apply) and save the figures to infoDir. See RunMetrics.py.
+# profilePhase:   A step to profile as well, eg 'match' ('' for none). Slows it down.
 #
 # File refs with escaping for Windows: "c:\\test data", "\\\\192.168.1.30\\my show"
 
@@ -103,6 +161,24 @@ manualSave = 0
 manualResume = 0
 showroot = ""
 searchMethod = 1
+excludeDirs = ['.actors']
+streamMode = 0
+streamBuffer = 500
+applyWorkers = 4
+applyShareLimit = 4
+applyRetries = 3
+incrementalRun = 1
+fullRun = 0
+useJournal = 1
+journalResume = 0
+cacheBudgetMB = 64
+useDiskCache = 1
+watchDelay = 5
+watchPolling = 0
+watchPollInterval = 60
+backupMode = 'store'
+collectMetrics = 1
+profilePhase = ''
 
 # Options below are strings or regex patterns.
 # fileFilters are EXCLUDED and are used with option 1 above.
@@ -119,12 +195,51 @@ searchMethod = 1
 #
 # Any non-numeric characters are stripped from season and episode patterns
 # by the script; you do not need to manually adjust for this.
+#
+# Method 2 can also match on other numbers in the filename instead of season and
+# episode. Set matchKey to one of:
+#   'seasonepisode' - seasonPattern and episodePattern (the default)
+#   'absolute'      - absolutePattern, an absolute episode number
+#   'airdate'       - airdatePattern, an air date written year, month, day (eg, 2001-03-05)
+#   'imdbid'        - imdbidPattern, eg tt0123456
+#   'tvdbid'        - tvdbidPattern, eg [tvdbid-12345]
+# and set the matching column (absoluteColumn, airdateColumn, imdbidColumn or
+# tvdbidColumn) below. Leading zeros don't matter, so 'e01' matches episode 1.
+# Set keySource to 'nfo' to take the key from the NFO's own season/episode,
+# imdbid or tvdbid fields instead of the filename (the patterns are then not
+# used); 'filename' is the default. NFOs have no absolute or airdate field, so
+# those keys always come from the filename.
+# If the same key appears on more than one row of your CSV, NFOs with that key
+# are not matched and are listed in the skipped log instead (earlier versions
+# silently used the last row).
 
 fileFilter1 = ''
 fileFilter2 = ''
 fileFilter3 = ''
 seasonPattern = '[Ss][0-9]+'
 episodePattern = '[Ee][0-9]+'
+matchKey = 'seasonepisode'
+absolutePattern = '[Ee][0-9]+'
+airdatePattern = '[0-9]{4}[-. ][0-9]{2}[-. ][0-9]{2}'
+imdbidPattern = 'tt[0-9]+'
+tvdbidPattern = 'tvdbid-[0-9]+'
+keySource = 'filename'
+
+# ## Trimming Titles As Well (optional) ###
+
+# trimTitles:   Set to 1 to also set each NFO's title from its filename, with the
+#                 trimFilters patterns taken out and appendTerm added on the end (as
+#                 TrimTitle.py does). The trimmed title replaces the CSV's title, and
+#                 NFOs that aren't matched (or are declined) get it as well.
+# trimFilters:  Patterns taken out of the filename, eg ['Show s[0-9]+e[0-9]+ ', ' \\([0-9]+p\\)'].
+# appendTerm:   Added on the end of the trimmed title, eg ' (Home Video)'.
+# setLockdata:  Set to 1 to set <lockdata>true</lockdata> in every NFO updated, or 0
+#                 to leave it as it is.
+
+trimTitles = 0
+trimFilters = []
+appendTerm = ''
+setLockdata = 1
 
 # ## Variables About Your Comparison Data ###
 
@@ -132,8 +247,19 @@ episodePattern = '[Ee][0-9]+'
 # or plot, title, season, and episode for option 2. Other columns are optional
 # for inclusion in the amended NFO. Mark absent columns as 'NA' (with quotes).
 # Your csv file must have numerical column headings that match the numbers entered here.
+#
+# useCatalog:  Set to 1 to import the CSV into an episode catalog in infoDir the first
+#                time (and again whenever it changes), and look episodes up there as
+#                needed instead of reading the whole CSV into memory every run. Run with
+#                --import-catalog to just import it. See EpisodeCatalog.py.
+# showColumn:  For a CSV with more than one show, the column with the show name, and
+# showName:      the show to match this run's NFOs against ('' for every row).
+#                (showName needs useCatalog.)
 
 dataFile = ""
+useCatalog = 1
+showColumn = 'NA'
+showName = ''
 seasonColumn = 0
 episodeColumn = 1
 titleColumn = 2
@@ -142,56 +268,184 @@ yearColumn = 'NA'
 runtimeColumn = 'NA'
 imdbidColumn = 'NA'
 tvdbidColumn = 'NA'
+absoluteColumn = 'NA'
+airdateColumn = 'NA'
+
+# ## Fuzzy Matching Speed Options (searchMethod 1 only) ###
+
+# scorerBackend:  'rapidfuzz' (default, much faster) or 'fuzzywuzzy' (as used by
+#                   earlier versions). See SCORERS in MatchTools.py.
+# scoreCutoff:    Matches scoring under this are treated as no match at all, and
+#                   titles are dropped as soon as they can't reach it. 0 keeps
+#                   every match, as in earlier versions.
+# useTitleIndex:  Set to 1 to index the CSV titles first, so each NFO is only compared
+#                   with titles that could plausibly match it instead of every title
+#                   in the CSV. Much faster on long shows/big catalogs. Set to 0 to
+#                   compare every NFO with every title in one big batch (needs numpy).
+#                   With useCatalog, 2 compares each NFO with just the catalogLimit
+#                   titles the catalog's title search finds closest; quickest of all
+#                   on very big catalogs, but not guaranteed to find the same match
+#                   (see TITLE SEARCH in EpisodeCatalog.py).
+# indexThreshold: Any match scoring this or better is guaranteed to be the same one
+#                   a full comparison would find (see MatchTools.py). Lower values
+#                   make the index less selective, and so slower; at 0 it compares
+#                   everything. Poorer matches may differ, but you would normally
+#                   decline those anyway.
+# indexFallback:  Set to 1 to compare an NFO with every title if the index finds
+#                   nothing close to it, or 0 to leave it unmatched.
+# matchWorkers:   Number of processes to match on. 1 matches on a single process as in
+#                   earlier versions, 0 uses one per CPU core. See MULTI-CORE MATCHING
+#                   in MatchTools.py.
+# matchChunkSize: How many NFOs are sent to a worker process at a time.
+# catalogLimit:   How many titles the catalog's title search picks (useTitleIndex 2).
+
+scorerBackend = 'rapidfuzz'
+scoreCutoff = 0
+useTitleIndex = 1
+indexThreshold = 80
+indexFallback = 1
+matchWorkers = 1
+matchChunkSize = 200
+catalogLimit = 50
+
+# ## Reviewing Fuzzy Matches (searchMethod 1 only) ###
+
+# reviewMode:     'triage' to review the matches a page at a time, best first, accepting
+#                   or refusing them in bulk by number (see MatchReview.py), or 'prompt'
+#                   to be asked about each match in turn, as in earlier versions. 'auto'
+#                   only accepts/refuses automatically (by autoAccept and autoReject)
+#                   and refuses anything else, without asking.
+# autoAccept:     In triage, matches scoring this or more are accepted without asking
+#                   (unless another NFO was matched to the same episode). 101 asks about all.
+# autoReject:     In triage, matches scoring this or less are refused without asking.
+# reviewPageSize: How many matches to show on each page.
+
+reviewMode = 'triage'
+autoAccept = 100
+autoReject = 0
+reviewPageSize = 20
 
 # ###################################################
 
+nfoKeyFields = {'seasonepisode': ['season', 'episode'], 'imdbid': ['imdbid'], 'tvdbid': ['tvdbid']}
+
+# The patterns and CSV columns in use, from the user variables above (and
+# worked out again by configure if they are changed).
+
+def makeKeyPatterns():
+   return {'seasonepisode': [seasonPattern, episodePattern], 'absolute': [absolutePattern],
+           'airdate': [airdatePattern], 'imdbid': [imdbidPattern], 'tvdbid': [tvdbidPattern]}
+
+def makeCatalogColumns():
+   return [{'season': seasonColumn}, {'episode': episodeColumn}, {'title': titleColumn}, {'plot': plotColumn},
+           {'year': yearColumn}, {'runtime': runtimeColumn}, {'imdbid': imdbidColumn}, {'tvdbid': tvdbidColumn},
+           {'absolute': absoluteColumn}, {'airdate': airdateColumn}, {'show': showColumn}]
+
+keyPatterns = makeKeyPatterns()
+catalogColumns = makeCatalogColumns()
+
 nfoData = []
 userData = []
 matchList = []
 declineList = []
+declinedRecords = []
+manifest = None
+journal = None
+nfoCache = None
+backupStore = None
+backupWith = False
+editor = None
+metrics = None
+runSummary = {}
 
 # Populate nfoData with filename, full path, and cleansed matching term(s).
+# extractNFOs hands these over one at a time as the folders are scanned, for
+# streamMode; makeNFOlist collects them all into nfoData.
 
-def makeNFOlist(filepath, filetype, method):
+# nfos: NFOScanner records to use instead of scanning filepath, and patterns
+# the compiled filters and patterns from makePatterns (both for watch mode).
+
+def makePatterns():
+   return {'filters': [re.compile(myFilter) for myFilter in [fileFilter1, fileFilter2, fileFilter3]],
+           'keys': [re.compile(myPattern) for myPattern in keyPatterns[matchKey]]}
+
+# NFOs only have fields for some kinds of key (see nfoKeyFields), so
+# keySource 'nfo' can't be used with the others.
+
+def checkKeySource(method):
+   if (method == 2) and (keySource == 'nfo') and (matchKey not in nfoKeyFields):
+      raise ValueError("Not a valid keySource/matchKey combination, please check user variables and try again.")
+
+def extractNFOs(filepath, filetype, method, nfos=None, patterns=None):
+   checkKeySource(method)
    id = 0
-   for root, dirs, files in os.walk(filepath):
-      #traverse directories and get files
-      for file in files:
-         # if file is an nfo, add name and full path to list
-         if file.lower().endswith(filetype.lower()):
-            if method == 1:
-               # add cleansed version of filename for matching purposes
-               searchTerm = str(file)
-               searchTerm = re.sub(fileFilter1, '', searchTerm)
-               searchTerm = re.sub(fileFilter2, '', searchTerm)
-               searchTerm = re.sub(fileFilter3, '', searchTerm)
-               searchTerm = searchTerm.replace('.nfo', '')
-               nfoData.append({"id": id, "filename": file, "root": root, "path": os.path.join(root, file), "matchname": searchTerm})
-               id += 1
-            elif method == 2:
-               searchTerm = []
-               mySrch = str(file)
-               mySrchSeas = re.search(seasonPattern, mySrch)
-               if mySrchSeas is None:
-                  mySrchSeas = "0"
-               else:
-                  mySrchSeas = re.sub('[^0-9]', '', mySrchSeas.group(0))
-               searchTerm.append(mySrchSeas)
-               mySrchEp = re.search(episodePattern, mySrch)
-               if mySrchEp is None:
-                  mySrchEp = "0"
+   # compile the filters and patterns once for the whole run
+   if patterns is None:
+      patterns = makePatterns()
+   myFilters = patterns['filters']
+   myPatterns = patterns['keys']
+   #traverse directories and get nfo files (see NFOScanner.py)
+   if nfos is None:
+      nfos = NFOScanner.scanNFOs(filepath, filetype, excludeDirs)
+   for nfo in nfos:
+      if (manifest is not None) and RunManifest.isUnchanged(manifest, nfo):
+         continue
+      file = nfo['filename']
+      root = nfo['root']
+      if method == 1:
+         # add cleansed version of filename for matching purposes
+         searchTerm = str(file)
+         for myFilter in myFilters:
+            searchTerm = myFilter.sub('', searchTerm)
+         searchTerm = searchTerm.replace('.nfo', '')
+      elif (method == 2) and (keySource == 'nfo'):
+         searchTerm = nfoKey(nfo)
+      elif method == 2:
+         searchTerm = []
+         mySrch = str(file)
+         for myPattern in myPatterns:
+            myMatch = myPattern.search(mySrch)
+            if myMatch is None:
+               # missing season/episode count as 0 (eg, specials), as they always have
+               if matchKey == 'seasonepisode':
+                  myMatch = "0"
                else:
-                  mySrchEp = re.sub('[^0-9]', '', mySrchEp.group(0))
-               searchTerm.append(mySrchEp)
-               nfoData.append({"id": id, "filename": file, "root": root, "path": os.path.join(root, file), "matchname": searchTerm})
-               id += 1
+                  myMatch = ""
             else:
-               return "Not a valid searchMethod, please check user variables and try again."
+               myMatch = re.sub('[^0-9]', '', myMatch.group(0))
+            searchTerm.append(myMatch)
+      yield {"id": id, "filename": file, "root": root, "path": nfo['path'], "size": nfo['size'], "mtime": nfo['mtime'], "matchname": searchTerm}
+      id += 1
+
+# For keySource 'nfo': the key from the NFO's own fields, in the same form as
+# one taken from the filename.
+
+def nfoKey(nfo):
+   record = NFOCache.getRecord(nfoCache, nfo['path'], nfo['size'], nfo['mtime'])
+   searchTerm = []
+   for item in nfoKeyFields[matchKey]:
+      myMatch = re.sub('[^0-9]', '', record.get(item, ''))
+      if (myMatch == '') and (matchKey == 'seasonepisode'):
+         myMatch = "0"
+      searchTerm.append(myMatch)
+   return searchTerm
+
+def makeNFOlist(filepath, filetype, method):
+   if method not in [1, 2]:
+      return "Not a valid searchMethod, please check user variables and try again."
+   nfoData.extend(extractNFOs(filepath, filetype, method))
    return
 
-if manualResume != 1: makeNFOlist(showroot, '.nfo', searchMethod)
+# Populate userData with episode data from the user's dataset. With
+# useCatalog, openEpisodeData gives a CatalogView instead, which looks rows up
+# in the catalog as they are needed (see EpisodeCatalog.py).
 
-# Populate userData with episode data from the user's dataset.
+def openEpisodeData(db):
+   if useCatalog == 1:
+      catalog = EpisodeCatalog.openCatalog(db, infoDir, catalogColumns)
+      return EpisodeCatalog.CatalogView(catalog, showName)
+   makeEpisodeList(db)
+   return userData
 
 def makeEpisodeList(db):
    id = 0
@@ -200,7 +454,7 @@ def makeEpisodeList(db):
       for row in reader:
          entry = {}
          entry.update({'id': id})
-         for ea in [{'season': seasonColumn}, {'episode': episodeColumn}, {'title': titleColumn}, {'plot': plotColumn}, {'year': yearColumn}, {'runtime': runtimeColumn}, {'imdbid': imdbidColumn}, {'tvdbid': tvdbidColumn}]:
+         for ea in catalogColumns:
             for key, value in ea.items():
                if value == 'NA':
                   pass
@@ -211,45 +465,129 @@ def makeEpisodeList(db):
          id += 1
    return
 
-if manualResume != 1: makeEpisodeList(dataFile)
-
-# Populate matchList with matches, then append update fields from userData
-
-def compareData(nfos, db, method):
-   for file in nfos:
-      entry = {'score': 0}
-      entry.update({'nfoID': file['id']})
-      entry.update({'filename': file['filename']})
-      entry.update({'root': file['root']})
-      entry.update({'path': file['path']})
-      entry.update({'matchname': file['matchname']})
+# Populate matchList with matches. Each is a MatchRecord pointing at its row
+# of userData, whose fields are only looked up when they're needed (see
+# MatchTools.py).
+# makeMatchSetup prepares the title index/scorer (method 1) or key index
+# (method 2) once, and matchNFOs then matches any number of NFOs with it.
+# (compareData does both for the whole of nfoData; streamMode calls
+# matchNFOs a buffer at a time.)
+
+# With a CatalogView, only the titles are loaded for method 1 (setup['ids']
+# turns a position in them back into a row id), and method 2 keys are looked
+# up in the catalog one NFO at a time.
+
+def makeMatchSetup(db, method):
+   setup = {'pool': None, 'ids': None, 'catalog': None}
+   isCatalog = isinstance(db, EpisodeCatalog.CatalogView)
+   if method == 1:
+      settings = {'scorerBackend': scorerBackend, 'scoreCutoff': scoreCutoff, 'useTitleIndex': useTitleIndex,
+                  'indexThreshold': indexThreshold, 'indexFallback': indexFallback}
+      if isCatalog and (useTitleIndex == 2) and db.catalog['titleSearch']:
+         setup.update({'catalog': db, 'scorer': MatchTools.getScorer(scorerBackend), 'titles': None})
+         return setup
+      if useTitleIndex == 2:
+         settings.update({'useTitleIndex': 1})
+      if isCatalog:
+         rows = db.titles()
+         titles = [str(row[1]) for row in rows]
+         setup.update({'ids': [row[0] for row in rows]})
+      else:
+         titles = [str(ep['title']) for ep in db]
+      if matchWorkers == 1:
+         setup.update({'matcher': MatchTools.makeMatcher(titles, settings)})
+      else:
+         setup.update({'pool': MatchTools.startMatchPool(titles, settings, matchWorkers)})
+   elif method == 2:
+      if isCatalog:
+         setup.update({'keyIndex': None})
+         MatchTools.reportDuplicateKeys({'duplicates': db.duplicateKeys(matchKey)}, matchKey)
+      else:
+         setup.update({'keyIndex': MatchTools.makeKeyIndex(db, matchKey)})
+         MatchTools.reportDuplicateKeys(setup['keyIndex'], matchKey)
+   return setup
+
+def closeMatchSetup(setup):
+   if setup['pool'] is not None:
+      setup['pool'].shutdown()
+
+# useTitleIndex 2: score each term against the titles the catalog's title
+# search picks for it, falling back to every title if it finds nothing.
+
+def catalogMatches(setup, terms):
+   results = []
+   for term in terms:
+      candidates = setup['catalog'].titleCandidates(term, catalogLimit)
+      myRatio, myPos = setup['scorer'].extractBest(term, [str(row[1]) for row in candidates], scoreCutoff)
+      if myPos is not None:
+         results.append((myRatio, candidates[myPos][0]))
+         continue
+      if (indexFallback == 1) and (len(term) > 0):
+         if setup['titles'] is None:
+            rows = setup['catalog'].titles()
+            setup.update({'titles': [str(row[1]) for row in rows], 'titleIDs': [row[0] for row in rows]})
+         myRatio, myPos = setup['scorer'].extractBest(term, setup['titles'], scoreCutoff)
+         if myPos is not None:
+            results.append((myRatio, setup['titleIDs'][myPos]))
+            continue
+      results.append((0, None))
+   return results
+
+def matchNFOs(nfos, db, method, setup):
+   entries = []
+   if method == 1:
+      terms = [str(file['matchname']) for file in nfos]
+      if setup['catalog'] is not None:
+         bestMatches = catalogMatches(setup, terms)
+      elif setup['pool'] is None:
+         bestMatches = MatchTools.matchTerms(setup['matcher'], terms)
+      else:
+         bestMatches = MatchTools.poolMatchTerms(setup['pool'], terms, matchChunkSize)
+      if setup['ids'] is not None:
+         bestMatches = [(myRatio, None if myPos is None else setup['ids'][myPos]) for myRatio, myPos in bestMatches]
+   for n, file in enumerate(nfos):
+      entry = MatchTools.MatchRecord(file, db)
       if method == 1:
-         for ep in db:
-            myRatio = fuzz.ratio(file['matchname'], ep['title'])
-            if myRatio > entry['score']:
-               entry.update({'score': myRatio})
-               entry.update({'matchtitle': ep['title']})
-               entry.update({'matchID': ep['id']})
-               entry.update(ep)
-         matchList.append(entry)
+         myRatio, myPos = bestMatches[n]
+         if myPos is not None:
+            entry.row = myPos
+            entry.score = myRatio
       elif method == 2:
-         for ep in db:
-            if (file['matchname'][0] == ep['season']) and (file['matchname'][1] == ep['episode']):
-               entry.update({'score': 100})
-               entry.update({'matchtitle': ep['title']})
-               entry.update({'matchID': ep['id']})
-               entry.update(ep)
-         matchList.append(entry)
-      else:
-         return("Invalid searchMethod, please check user variables and try again.")
+         myKey = MatchTools.normaliseKey(matchKey, file['matchname'])
+         if setup['keyIndex'] is None:
+            myRows = [] if myKey is None else db.findKey(matchKey, myKey)
+            myPos = myRows[0] if len(myRows) == 1 else None
+         elif myKey not in setup['keyIndex']['duplicates']:
+            myPos = setup['keyIndex']['keys'].get(myKey)
+         else:
+            myPos = None
+         if myPos is not None:
+            entry.row = myPos
+            entry.score = 100
+      entries.append(entry)
+   return entries
 
-if manualResume != 1: compareData(nfoData, userData, searchMethod)
+def compareData(nfos, db, method):
+   if method not in [1, 2]:
+      return("Invalid searchMethod, please check user variables and try again.")
+   setup = makeMatchSetup(db, method)
+   try:
+      matchList.extend(matchNFOs(nfos, db, method, setup))
+   finally:
+      closeMatchSetup(setup)
 
 # For searchMethod 1 (episode name fuzzy matching), present user
-# each match to confirm
+# each match to confirm. NFOs with no match at all (eg, nothing reached
+# scoreCutoff) are declined without asking. seen: see reviewStream.
 
-def userAccept(db):
+def userAccept(db, seen=None):
+   if reviewMode in ['triage', 'auto']:
+      MatchReview.triage(db, infoDir, autoAccept, autoReject, reviewPageSize, reviewMode == 'triage', seen)
+      return
    for ea in db:
+      if ea['score'] == 0:
+         ea.update({'accept': 0})
+         continue
       suggestedText1 = "SUGGESTED MATCH: " + ea['matchname'] + " AND " + ea['matchtitle']
       suggestedText2 = " (" + str(ea['score']) + "% CONFIDENCE)"
       print(suggestedText1 + suggestedText2)
@@ -259,48 +597,62 @@ def userAccept(db):
       else:
          ea.update({'accept': 0})
 
-if manualResume != 1:
-   if searchMethod == 1:
-      userAccept(matchList)
-
 # Function to pull selected existing NFO data and add to matchList.
 # Only used for manualSave cases since this will sometimes have manually
 # added data the user might wish to retain. The data is not presently used
-# for the update step or anything else by the script (but could possibly
-# be the basis of further matching functionality using NFO content in future).
+# for the update step. The NFO is read through nfoCache, so the update step
+# (and keySource 'nfo') don't read it again.
 
 def getExtraData(db):
    for ea in db:
-      mytree = ET.parse(ea['path'])
-      myroot = mytree.getroot()
       if ea.get('matchID') is None:
          continue
-      mydata = ea['matchID']
+      record = NFOCache.getRecord(nfoCache, ea['path'])
       #get data
       for item in ['season', 'episode', 'title', 'plot', 'year', 'runtime', 'imdbid', 'tvdbid']:
-         try:
-            for tag in myroot.iter(item):
-               ea.update({str('nfo' + item): tag.text})
-         except:
-            ea.update({str('nfo' + item): 'null'})
+         if item in record:
+            ea.update({str('nfo' + item): record[item]})
+
+# Columns of the _Matched.csv update table, in the order they have always
+# been written: match details, the CSV fields in use, then the accept flag
+# (method 1) and existing NFO data (manualSave).
+
+def matchFields(method, qa):
+   fields = ['score', 'nfoID', 'filename', 'root', 'path', 'matchname', 'matchtitle', 'matchID', 'id']
+   for ea in catalogColumns:
+      for key, value in ea.items():
+         if value != 'NA':
+            fields.append(key)
+   if method == 1:
+      fields.append('accept')
+   if qa == 1:
+      for item in ['season', 'episode', 'title', 'plot', 'year', 'runtime', 'imdbid', 'tvdbid']:
+         fields.append('nfo' + item)
+   return fields
+
+def isDeclined(ea, method):
+   if method == 1:
+      return ea['accept'] == 0
+   return ea['score'] == 0
+
+def qaExit():
+   print('Manual save flag found (usually set for QA), not proceeding to edits.')
+   print('You will need to re-run with the flag removed to execute the changes.')
+   print('Optionally you can also manualResume with manual edits, see script comments for details.')
+   closeRun()
+   sys.exit()
 
 # Create unmatched log and delete from matchList. Save record of Skipped and Matched.
 # Check for manualSave flag. If 1, quit. (Use manualResume and saved file to continue).
 
 def noMatchLog(db, method, qa):
-   dellist = []
-   if method == 1:
-      for ea in db:
-         if ea['accept'] == 0:
-            declineList.append(ea['path'])
-            dellist.append(ea)
-   elif method == 2:
-      for ea in db:
-         if ea['score'] == 0:
-            declineList.append(ea['path'])
-            dellist.append(ea)
-   for ea in dellist:
-      matchList.remove(ea)
+   for ea in db:
+      if isDeclined(ea, method):
+         declineList.append(ea['path'])
+         # with trimTitles, declined NFOs still get their titles trimmed
+         if trimTitles == 1:
+            declinedRecords.append(ea)
+   matchList[:] = [ea for ea in matchList if not isDeclined(ea, method)]
    now = datetime.now()
    destFile = infoDir + now.strftime("%Y-%m-%d %H-%M-%S") + "_Skipped.txt"
    f = open(destFile, "a")
@@ -310,52 +662,299 @@ def noMatchLog(db, method, qa):
    # Save update table:
    now = datetime.now()
    destFile = infoDir + now.strftime("%Y-%m-%d %H-%M-%S") + "_Matched.csv"
-   keys = matchList[0].keys()
    with open(destFile, 'w', encoding='utf8', newline='') as myFile:
-      dict_writer = csv.DictWriter(myFile, keys)
+      dict_writer = csv.DictWriter(myFile, matchFields(method, qa))
       dict_writer.writeheader()
-      dict_writer.writerows(matchList)
+      dict_writer.writerows(ea.asRow() for ea in matchList)
    print("Items that were matched are logged at " + destFile + ".\n")
+   runSummary.update({'matched': len(matchList), 'skipped': len(declineList)})
    if qa == 1:
-      print('Manual save flag found (usually set for QA), not proceeding to edits.')
-      print('You will need to re-run with the flag removed to execute the changes.')
-      print('Optionally you can also manualResume with manual edits, see script comments for details.')
-      sys.exit()
-
-if manualResume != 1:
-   if manualSave == 1:
-      getExtraData(matchList)
-   noMatchLog(matchList, searchMethod, manualSave)
-
-if manualResume == 1:
-   #import resumeFile and replace matchList
-   with open(resumeFile) as file:
-      reader = csv.DictReader(file)
-      matchList = list(reader)
+      qaExit()
+
+# The settings that decide what a run does to each NFO, for incrementalRun.
+
+def runSettings():
+   return {'searchMethod': searchMethod, 'excludeDirs': excludeDirs, 'fileFilters': [fileFilter1, fileFilter2, fileFilter3],
+           'matchKey': matchKey, 'keySource': keySource, 'keyPatterns': keyPatterns, 'catalogColumns': catalogColumns,
+           'scorerBackend': scorerBackend, 'scoreCutoff': scoreCutoff, 'useTitleIndex': useTitleIndex,
+           'indexThreshold': indexThreshold, 'indexFallback': indexFallback, 'showName': showName,
+           'catalogLimit': catalogLimit, 'trimTitles': trimTitles, 'trimFilters': trimFilters, 'appendTerm': appendTerm,
+           'setLockdata': setLockdata}
+
+# ## Streaming mode (streamMode = 1) ###
+# The same steps as above, chained together so each NFO passes straight from
+# one step to the next instead of each step finishing the whole show first.
+# Only streamBuffer NFOs are held at once (they are matched a buffer at a
+# time), and the skipped log and update table are written as NFOs go past,
+# so memory use stays the same however big the library is.
+
+def makeBuffers(items, size):
+   buffer = []
+   for item in items:
+      buffer.append(item)
+      if len(buffer) >= size:
+         yield buffer
+         buffer = []
+   if buffer:
+      yield buffer
+
+# setup: a match setup from makeMatchSetup to use (and leave open), rather
+# than making one (for watch mode).
+
+def matchStream(nfos, db, method, setup=None):
+   ownSetup = setup is None
+   if ownSetup:
+      setup = makeMatchSetup(db, method)
+   try:
+      for buffer in makeBuffers(nfos, streamBuffer):
+         for entry in matchNFOs(buffer, db, method, setup):
+            yield entry
+   finally:
+      if ownSetup:
+         closeMatchSetup(setup)
+
+# Matches are reviewed a buffer at a time (so in triage, each page is drawn
+# from one streamBuffer of NFOs). seen counts the NFOs matched to each row
+# so far, so triage flags an NFO matched to the same row as one in an earlier
+# buffer (see MatchReview.py).
+
+def reviewStream(entries, method, qa):
+   seen = {}
+   for buffer in makeBuffers(entries, streamBuffer):
+      if method == 1:
+         userAccept(buffer, seen)
+      for ea in buffer:
+         if qa == 1:
+            getExtraData([ea])
+         yield ea
 
-# Execute file changes
+# Writes the skipped log in the same format as noMatchLog, a bit at a time.
 
-def nfoEdits(db):
-   for ea in db:
-      #back up nfo
-      original = str(ea['path'])
-      target = str(ea['path']) + '.bak'
-      shutil.copyfile(original, target)
-      mytree = ET.parse(ea['path'])
-      myroot = mytree.getroot()
-#      mydata = src[ea['matchID']]
-      #edits
-      for item in ['season', 'episode', 'title', 'plot', 'year', 'runtime', 'imdbid', 'tvdbid']:
-         try:
-            for tag in myroot.iter(item):
-               tag.text = ea[item]
-         except:
+def logStream(entries, method, qa):
+   now = datetime.now()
+   skippedFile = infoDir + now.strftime("%Y-%m-%d %H-%M-%S") + "_Skipped.txt"
+   matchedFile = infoDir + now.strftime("%Y-%m-%d %H-%M-%S") + "_Matched.csv"
+   with open(skippedFile, "a") as skipped, open(matchedFile, 'w', encoding='utf8', newline='') as matched:
+      dict_writer = csv.DictWriter(matched, matchFields(method, qa))
+      dict_writer.writeheader()
+      skipped.write('[')
+      separator = ''
+      runSummary.update({'matched': 0, 'skipped': 0})
+      for ea in entries:
+         if isDeclined(ea, method):
+            skipped.write(separator + repr(ea['path']))
+            separator = ', '
+            runSummary['skipped'] += 1
+            if trimTitles == 1:
+               yield ea
+            continue
+         dict_writer.writerow(ea.asRow())
+         runSummary['matched'] += 1
+         yield ea
+      skipped.write(']')
+   print("\n\nItems that could not be matched are logged at " + skippedFile + ".")
+   print("Items that were matched are logged at " + matchedFile + ".\n")
+
+# Each step is timed on its own (see RunMetrics.py), with bytes and memory
+# for the whole stream.
+
+def runStream():
+   with RunMetrics.phase(metrics, 'stream'):
+      entries = RunMetrics.timedStream(metrics, 'scan', extractNFOs(showroot, '.nfo', searchMethod))
+      entries = RunMetrics.timedStream(metrics, 'match', matchStream(entries, userData, searchMethod))
+      entries = RunMetrics.timedStream(metrics, 'review', reviewStream(entries, searchMethod, manualSave))
+      entries = RunMetrics.timedStream(metrics, 'log', logStream(entries, searchMethod, manualSave))
+      if manualSave == 1:
+         for ea in entries:
             pass
-      for tag in myroot.iter('lockdata'):
-         tag.text = 'true'
-      mytree.write(ea['path'])
+         qaExit()
+      with RunMetrics.phase(metrics, 'apply', False):
+         nfoEdits(entries)
+
+# ## Watch mode (--watch) ###
+# Runs the streamMode steps on each batch of new or changed NFOs, with the
+# episode data, match setup and patterns made once and kept between batches
+# (see NFOWatch.py). Nobody is there to review fuzzy matches, so they are
+# reviewed with reviewMode 'auto'.
+
+def watchShow():
+   global reviewMode
+   if (searchMethod == 1) and (reviewMode != 'auto'):
+      print("Fuzzy matches found while watching are accepted or refused automatically (reviewMode 'auto').")
+      reviewMode = 'auto'
+   db = openEpisodeData(dataFile)
+   setup = makeMatchSetup(db, searchMethod)
+   patterns = makePatterns()
+
+   def handleBatch(nfos):
+      with RunMetrics.phase(metrics, 'stream'):
+         entries = RunMetrics.timedStream(metrics, 'scan', extractNFOs(showroot, '.nfo', searchMethod, nfos, patterns))
+         entries = RunMetrics.timedStream(metrics, 'match', matchStream(entries, db, searchMethod, setup))
+         entries = RunMetrics.timedStream(metrics, 'review', reviewStream(entries, searchMethod, 0))
+         entries = RunMetrics.timedStream(metrics, 'log', logStream(entries, searchMethod, 0))
+         with RunMetrics.phase(metrics, 'apply', False):
+            nfoEdits(entries)
+      if manifest is not None:
+         RunManifest.saveManifest(manifest)
+
+   # each NFO is noted as it's done, so the watcher can tell our writes apart
+   handled = {}
+   editor.update({'written': handled})
+   try:
+      NFOWatch.watchFolder(showroot, '.nfo', excludeDirs, handleBatch, watchDelay, watchPollInterval, watchPolling, handled)
+   finally:
+      closeMatchSetup(setup)
+
+# Execute file changes with the transforms below, in one pass per NFO (see
+# NFOTransform.py). Only the changed fields are rewritten (see NFOPatch.py);
+# NFOs that already have the right values are left alone and not backed up.
+# Several NFOs are updated at once (see NFOApply.py).
+
+# The CSV fields of the matched row (declined NFOs, only here with
+# trimTitles, get nothing from the CSV).
+
+def fillFromMatch(ea, fields):
+   if isinstance(ea, MatchTools.MatchRecord) and isDeclined(ea, searchMethod):
+      return
+   NFOTransform.catalogFill(ea, fields)
+
+def makeTransforms():
+   transforms = [fillFromMatch]
+   if trimTitles == 1:
+      transforms.append(NFOTransform.trimTitle(trimFilters, appendTerm))
+   if setLockdata == 1:
+      transforms.append(NFOTransform.lockData)
+   return transforms
+
+# Only matched NFOs are marked done for incrementalRun, so declined ones are
+# looked at again next time.
+
+def isMatched(ea):
+   return not (isinstance(ea, MatchTools.MatchRecord) and isDeclined(ea, searchMethod))
 
-if manualSave != 1: nfoEdits(matchList)
+def nfoEdits(db):
+   report = NFOTransform.applyAll(editor, db, applyWorkers, applyShareLimit, applyRetries)
+   RunMetrics.count(metrics, 'apply', sum(report['counts'].values()) + len(report['errors']))
+   runSummary.update({'updated': report['counts'].get(True, 0), 'unchanged': report['counts'].get(False, 0), 'failed': len(report['errors'])})
+   return report
+
+# ################ RUN THE SCRIPT ###############
+# Each step below is one of the functions above. The steps are kept in main,
+# run only when this file is run as a script, so that the worker processes
+# used by matchWorkers (and BatchRun.py) can load this file without running
+# it all again.
+
+# Change user variables from code rather than by editing this file (see
+# BatchRun.py). settings is a dict of variable name: new value.
+
+def configure(settings):
+   for name, value in settings.items():
+      if name not in globals():
+         raise ValueError("Unknown setting '" + name + "', please check the name and try again.")
+      globals().update({name: value})
+   keyPatterns.update(makeKeyPatterns())
+   catalogColumns[:] = makeCatalogColumns()
+
+# Run the script. argv holds any options (--full, --resume, --import-catalog, --watch).
+# Returns runSummary.
+
+def main(argv):
+   global journal, manifest, nfoCache, backupStore, backupWith, editor, metrics, userData, matchList, journalResume, fullRun
+   if '--import-catalog' in argv:
+      EpisodeCatalog.openCatalog(dataFile, infoDir, catalogColumns, 1)
+      sys.exit()
+   checkKeySource(searchMethod)
+   if '--resume' in argv:
+      journalResume = 1
+   if (useJournal == 1) or (journalResume == 1):
+      journal = RunJournal.openJournal(infoDir)
+      if (len(journal['previous']) > 0) and (journalResume != 1) and (manualSave != 1):
+         print("The last run did not finish updating " + str(len(journal['previous'])) + " NFOs.")
+         print("Run with --resume (or set journalResume to 1) to finish them first. See RunJournal.py.")
+         sys.exit()
+   if collectMetrics == 1:
+      metrics = RunMetrics.openMetrics('FixFromDB', infoDir, profilePhase)
+
+   if incrementalRun == 1:
+      if ('--full' in argv) or (fullRun == 1):
+         fullRun = 1
+      catalogVersion = ''
+      if (dataFile != '') and os.path.exists(dataFile):
+         catalogVersion = EpisodeCatalog.csvHash(dataFile, infoDir)
+      manifest = RunManifest.openManifest(infoDir, 'FixFromDB', catalogVersion, RunManifest.configVersion(runSettings()), fullRun)
+
+   if useDiskCache == 1:
+      nfoCache = NFOCache.openCache(cacheBudgetMB, infoDir)
+   else:
+      nfoCache = NFOCache.openCache(cacheBudgetMB)
+   backupStore = BackupStore.openStore(infoDir, 'FixFromDB')
+   backupWith = BackupStore.backupMethod(backupMode, backupStore)
+   editor = NFOTransform.openEngine(makeTransforms(), nfoCache, backupWith, journal, manifest, isMatched)
+
+   if journalResume == 1:
+      # the changes planned last time, exactly as they were
+      editor = NFOTransform.openEngine([NFOTransform.replayFields], nfoCache, backupWith, journal, manifest)
+      print("Finishing " + str(len(journal['previous'])) + " NFO updates left over from the last run.")
+      with RunMetrics.phase(metrics, 'apply'):
+         report = nfoEdits(RunJournal.unfinishedEntries(journal))
+      for path, message in report['errors']:
+         RunJournal.record(journal, path, 'failed')
+   elif manualResume == 1:
+      #import resumeFile and replace matchList
+      with RunMetrics.phase(metrics, 'load'):
+         with open(resumeFile) as file:
+            reader = csv.DictReader(file)
+            matchList = list(reader)
+      if manualSave != 1:
+         with RunMetrics.phase(metrics, 'apply'):
+            nfoEdits(matchList)
+   elif '--watch' in argv:
+      watchShow()
+   elif streamMode == 1:
+      with RunMetrics.phase(metrics, 'load'):
+         userData = openEpisodeData(dataFile)
+      RunMetrics.count(metrics, 'load', len(userData))
+      runStream()
+   else:
+      with RunMetrics.phase(metrics, 'scan'):
+         makeNFOlist(showroot, '.nfo', searchMethod)
+      RunMetrics.count(metrics, 'scan', len(nfoData))
+      with RunMetrics.phase(metrics, 'load'):
+         userData = openEpisodeData(dataFile)
+      RunMetrics.count(metrics, 'load', len(userData))
+      with RunMetrics.phase(metrics, 'match'):
+         compareData(nfoData, userData, searchMethod)
+      RunMetrics.count(metrics, 'match', len(matchList))
+      if searchMethod == 1:
+         with RunMetrics.phase(metrics, 'review'):
+            userAccept(matchList)
+         RunMetrics.count(metrics, 'review', len(matchList))
+      if manualSave == 1:
+         with RunMetrics.phase(metrics, 'extra'):
+            getExtraData(matchList)
+      with RunMetrics.phase(metrics, 'log'):
+         noMatchLog(matchList, searchMethod, manualSave)
+      RunMetrics.count(metrics, 'log', len(matchList) + len(declineList))
+      with RunMetrics.phase(metrics, 'apply'):
+         nfoEdits(matchList + declinedRecords)
+
+   closeRun()
+   return runSummary
+
+# Close everything main opened (also on the manualSave exit, see qaExit).
+
+def closeRun():
+   if journal is not None:
+      RunJournal.closeJournal(journal)
+   if manifest is not None:
+      runSummary.update({'unchangedSinceLastRun': manifest['skipped']})
+      RunManifest.closeManifest(manifest)
+   NFOCache.closeCache(nfoCache)
+   BackupStore.closeStore(backupStore)
+   RunMetrics.saveMetrics(metrics, runSummary)
+
+if __name__ == '__main__':
+   main(sys.argv)
 
 # APPENDIX 1: OTHER MATCHING OPTIONS IN THE NFO FILENAME
 #
@@ -373,16 +972,15 @@ if manualSave != 1: nfoEdits(matchList)
 #   as appropriate.
 #
 # You may also want to activate the on-screen approval steps used for fuzzy matches by
-# editing the line after the function userAccept above:
+# editing the lines in main (RUN THE SCRIPT) above:
 #   if searchMethod == 1:
 #       userAccept(matchList).
 #
 # APPENDIX 2: OTHER MATCHING OPTIONS IN THE NFO DATA
 #
-# This script as designed scrapes the comparison data from the NFO filename. It would be
-# possible to modify the script to instead scrape from the actual NFO XML content. You would
-# need to edit the function makeNFOlist. You might use some of the code in the function
-# nfoEdits as a starting point for extracting what you need.
+# This script as designed scrapes the comparison data from the NFO filename. For method 2,
+# keySource 'nfo' takes it from the NFO's own fields instead (see nfoKey). For other
+# fields, add them to fieldNames in NFOCache.py and read them with NFOCache.getRecord.
 #
 # APPENDIX 3: FIXING INCORRECT THUMBNAILS
 #
@@ -0,0 +1,161 @@
+import os
+import re
+import json
+
+# ############## ABOUT THIS FILE #####################
+#
+# The triage review used by FixFromDB.py (reviewMode 'triage') to approve fuzzy
+# matches (searchMethod 1) a page at a time, instead of answering y/n for
+# every single NFO.
+#
+# - Matches scoring autoAccept or more are accepted without asking, and
+#   matches scoring autoReject or less are refused without asking.
+# - The rest are listed best score first, reviewPageSize to a page, and can be
+#   accepted or refused in bulk by their numbers, eg 'a 1-12,15' or 'r 16-20'
+#   ('a all' / 'r all' for everything not yet decided).
+# - Where two or more NFOs have been matched to the same CSV row, they are
+#   flagged with a * and always listed for review, whatever their score.
+# - Every decision is saved to FixFromDB_review.json in infoDir as it's made.
+#   If the review is interrupted, the next run picks up the saved decisions
+#   (for NFOs still matched to the same row) and starts at the first page
+#   with anything left to decide. The file is deleted once the review is done.
+#
+# In streamMode, FixFromDB.py reviews one streamBuffer of NFOs at a time, so:
+# - NFOs are checked against every NFO matched in earlier buffers as well as
+#   their own buffer. Those from earlier buffers have already gone on to be
+#   updated, so only the later NFO matched to the same row is flagged.
+# - The saved decisions are deleted as each buffer's review is done, so an
+#   interrupted review only picks up the decisions for the buffer it was on.
+#   (With incrementalRun, NFOs accepted in earlier buffers are skipped next time.)
+#
+# reviewMode 'auto' does the automatic part only, refusing everything that
+# would have been listed for review (they go in the skipped log, to be looked
+# at in a later run). This is what BatchRun.py uses, as nobody is there to answer.
+#
+# ###################################################
+
+reviewFile = 'FixFromDB_review.json'
+
+def loadDecisions(path):
+   if not os.path.exists(path):
+      return {}
+   with open(path, encoding='utf-8') as file:
+      return json.load(file)
+
+# Save the decisions so far, replacing the file in one go so an interruption
+# can't leave it half written.
+
+def saveDecisions(path, decisions):
+   with open(path + '.tmp', 'w', encoding='utf-8') as file:
+      json.dump(decisions, file)
+   os.replace(path + '.tmp', path)
+
+# matchIDs that more than one of records is matched to, with how many.
+# seen: how many NFOs were matched to each matchID in earlier calls (streamMode
+# buffers), which counts towards these and is updated with them.
+
+def findDuplicates(records, seen=None):
+   counts = {} if seen is None else dict(seen)
+   for ea in records:
+      if ea['score'] == 0:
+         continue
+      counts.update({ea['matchID']: counts.get(ea['matchID'], 0) + 1})
+   if seen is not None:
+      seen.update(counts)
+   return {matchID: count for matchID, count in counts.items() if count > 1}
+
+# Numbers (1 to count) picked out by text such as '1-12,15', as positions in
+# the review list. 'all' picks everything. Returns None if text doesn't make sense.
+
+def parseRanges(text, count):
+   if text.strip() == 'all':
+      return list(range(count))
+   picked = []
+   for part in text.split(','):
+      bounds = re.fullmatch(r'\s*([0-9]+)\s*(?:-\s*([0-9]+)\s*)?', part)
+      if bounds is None:
+         return None
+      first = int(bounds.group(1))
+      last = int(bounds.group(2) or first)
+      if (first < 1) or (last > count) or (first > last):
+         return None
+      picked.extend(range(first - 1, last))
+   return picked
+
+def showPage(grey, page, pageSize, duplicates):
+   pages = (len(grey) + pageSize - 1) // pageSize
+   print("\nMATCHES TO REVIEW, PAGE " + str(page + 1) + " OF " + str(pages) + " (y accepted, n refused, * same episode as another NFO)")
+   for n in range(page * pageSize, min((page + 1) * pageSize, len(grey))):
+      ea = grey[n]
+      mark = {1: 'y', 0: 'n'}.get(ea.get('accept'), ' ')
+      flag = '*' if ea['matchID'] in duplicates else ' '
+      print(str(n + 1).rjust(5) + ". [" + mark + "]" + flag + str(ea['score']).rjust(4) + "%  " + str(ea['matchname']) + "  AND  " + str(ea['matchtitle']))
+
+# Review records (matches from FixFromDB.py), setting accept on each. folder
+# is where the decisions are saved. interactive: False for reviewMode 'auto'.
+# seen: as for findDuplicates, kept by the caller across streamMode buffers.
+
+def triage(records, folder, autoAccept=100, autoReject=0, pageSize=20, interactive=True, seen=None):
+   path = folder + reviewFile
+   decisions = loadDecisions(path)
+   duplicates = findDuplicates(records, seen)
+   grey = []
+   accepted = 0
+   refused = 0
+   for ea in records:
+      if (ea['score'] == 0) or (ea['score'] <= autoReject):
+         ea.update({'accept': 0})
+         refused += 1
+         continue
+      if (ea['score'] >= autoAccept) and (ea['matchID'] not in duplicates):
+         ea.update({'accept': 1})
+         accepted += 1
+         continue
+      saved = decisions.get(ea['path'])
+      if (saved is not None) and (saved[0] == ea['matchID']):
+         ea.update({'accept': saved[1]})
+      grey.append(ea)
+   grey.sort(key=lambda ea: -ea['score'])
+   print("\n" + str(accepted) + " matches accepted automatically, " + str(refused) + " refused automatically, "
+         + str(len(grey)) + " to review.")
+   if len(duplicates) > 0:
+      print(str(len(duplicates)) + " episodes were matched to more than one NFO; these are marked * below.")
+   if len(grey) == 0:
+      return
+   if not interactive:
+      for ea in grey:
+         ea.update({'accept': 0})
+      print(str(len(grey)) + " matches that needed reviewing were refused (see the skipped log).")
+      return
+   pages = (len(grey) + pageSize - 1) // pageSize
+   page = 0
+   while (page < pages - 1) and all(ea.get('accept') is not None for ea in grey[page * pageSize:(page + 1) * pageSize]):
+      page += 1
+   while True:
+      showPage(grey, page, pageSize, duplicates)
+      answer = input("a <numbers> to accept, r <numbers> to refuse (eg a 1-5,8 or r all), n/p for next/previous page, "
+                     "d when done (anything not decided is refused)").strip().lower()
+      if answer == 'n':
+         page = min(page + 1, pages - 1)
+      elif answer == 'p':
+         page = max(page - 1, 0)
+      elif answer == 'd':
+         break
+      elif answer[:2] in ['a ', 'r ']:
+         picked = parseRanges(answer[2:], len(grey))
+         if picked is None:
+            print("Not a valid list of numbers, try again.")
+            continue
+         for n in picked:
+            if (answer[2:].strip() == 'all') and (grey[n].get('accept') is not None):
+               continue
+            grey[n].update({'accept': 1 if answer[0] == 'a' else 0})
+            decisions.update({grey[n]['path']: [grey[n]['matchID'], grey[n]['accept']]})
+         saveDecisions(path, decisions)
+      else:
+         print("Not a valid choice, try again.")
+   for ea in grey:
+      if ea.get('accept') is None:
+         ea.update({'accept': 0})
+   if os.path.exists(path):
+      os.remove(path)
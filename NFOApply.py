@@ -0,0 +1,113 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# ############## ABOUT THIS FILE #####################
+#
+# Runs the NFO update step of FixFromDB.py and TrimTitle.py on several files
+# at once. On a network share most of the time goes on waiting for the NAS
+# to answer (open, read, back up, write), so working on a few files at a
+# time is much faster than one after another, even on one CPU core.
+#
+# - applyWorkers sets how many files are worked on at once overall, and
+#   applyShareLimit how many of those can be on the same share or drive
+#   (\\server\share, C:, or the mount point on Linux/Mac), so one slow NAS
+#   isn't flooded.
+# - If a file fails with a network-type error, it is retried up to
+#   applyRetries times, waiting a little longer each time (0.5s, 1s, 2s...).
+#   Errors that won't fix themselves (file not found, permission denied,
+#   a broken NFO) are not retried.
+# - A failed file doesn't stop the run. Failures are listed together at the end.
+#
+# With applyWorkers = 1 the files are done one at a time, as in earlier versions
+# (but still with retries and the error list).
+#
+# ###################################################
+
+permanentErrors = (FileNotFoundError, PermissionError, IsADirectoryError, NotADirectoryError)
+mountCache = {}
+
+# The share, drive or mount point a file is on.
+
+def shareOf(path):
+   path = os.path.abspath(str(path))
+   drive = os.path.splitdrive(path)[0]
+   if drive:
+      return drive.lower()
+   folder = os.path.dirname(path)
+   if folder not in mountCache:
+      mount = folder
+      while not os.path.ismount(mount):
+         mount = os.path.dirname(mount)
+      mountCache.update({folder: mount})
+   return mountCache[folder]
+
+# Run work(item), retrying network-type errors. The share's slot is only held
+# while work is actually running, not while waiting to retry.
+
+def runWithRetry(work, item, slot, retries, backoff):
+   attempt = 0
+   while True:
+      try:
+         with slot:
+            return work(item)
+      except OSError as error:
+         if isinstance(error, permanentErrors) or (attempt >= retries):
+            raise
+         time.sleep(backoff * (2 ** attempt))
+         attempt += 1
+
+# Run work on every item (each a dict with a 'path'), workers at a time and
+# at most perShare at a time on any one share. items can be a list or a
+# generator; only a few more items than workers are taken from it at a time.
+# Returns a report: counts of each value work returned, and a list of
+# (path, error message) for items that failed.
+
+def applyConcurrently(items, work, workers=4, perShare=4, retries=3, backoff=0.5):
+   report = {'counts': {}, 'errors': []}
+   slots = {}
+
+   def collect(path, future):
+      try:
+         result = future.result()
+      except Exception as error:
+         report['errors'].append((path, type(error).__name__ + ": " + str(error)))
+         return
+      report['counts'].update({result: report['counts'].get(result, 0) + 1})
+
+   if workers == 1:
+      slot = threading.Lock()
+      for item in items:
+         try:
+            result = runWithRetry(work, item, slot, retries, backoff)
+         except Exception as error:
+            report['errors'].append((item['path'], type(error).__name__ + ": " + str(error)))
+            continue
+         report['counts'].update({result: report['counts'].get(result, 0) + 1})
+      return report
+
+   pending = {}
+   with ThreadPoolExecutor(max_workers=workers) as pool:
+      for item in items:
+         share = shareOf(item['path'])
+         if share not in slots:
+            slots.update({share: threading.BoundedSemaphore(perShare)})
+         future = pool.submit(runWithRetry, work, item, slots[share], retries, backoff)
+         pending.update({future: item['path']})
+         if len(pending) >= workers * 4:
+            done = wait(pending, return_when=FIRST_COMPLETED)[0]
+            for future in done:
+               collect(pending.pop(future), future)
+      for future in wait(pending)[0]:
+         collect(pending[future], future)
+   return report
+
+# Print the list of failed files from an applyConcurrently report.
+
+def reportErrors(report):
+   if len(report['errors']) == 0:
+      return
+   print("\n" + str(len(report['errors'])) + " NFOs could not be updated:")
+   for path, message in report['errors']:
+      print("   " + str(path) + " (" + message + ")")
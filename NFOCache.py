@@ -0,0 +1,130 @@
+import os
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+import NFOPatch
+
+# ############## ABOUT THIS FILE #####################
+#
+# Reads each NFO at most once per run, however many steps need it. FixFromDB.py
+# can look at an NFO's contents up to three times - matching on NFO content
+# (keySource 'nfo'), saving existing NFO data for manual QA (getExtraData) and
+# updating it (nfoEdits) - and this cache serves all of them.
+#
+# For each NFO it keeps:
+# - a small record of the fields the scripts use (season, episode, title,
+#   plot, year, runtime, imdbid, tvdbid, lockdata), and
+# - the NFO text itself, so the update step doesn't have to read it again.
+# The NFO texts are dropped, least recently used first, once they take up more
+# than cacheBudgetMB; records are kept within the same budget.
+#
+# With a diskFolder, the records are also saved to NFO_cache.sqlite there,
+# labelled with the NFO's size and modified time, so later runs can use them
+# without opening unchanged NFOs at all.
+#
+# Before anything cached is used, the NFO's size and modified time are checked,
+# so an NFO changed by something else is always read fresh.
+#
+# ###################################################
+
+fieldNames = ['season', 'episode', 'title', 'plot', 'year', 'runtime', 'imdbid', 'tvdbid', 'lockdata']
+cacheFile = 'NFO_cache.sqlite'
+
+def openCache(budgetMB=64, diskFolder=None):
+   cache = {'budget': budgetMB * 1024 * 1024, 'lock': threading.Lock(), 'docs': OrderedDict(), 'docBytes': 0,
+            'records': OrderedDict(), 'recordBytes': 0, 'disk': None, 'reads': 0}
+   if diskFolder is not None:
+      conn = sqlite3.connect(diskFolder + cacheFile, check_same_thread=False)
+      conn.execute('CREATE TABLE IF NOT EXISTS records (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, fields TEXT)')
+      cache.update({'disk': conn})
+   return cache
+
+# The fields of an NFO's text, as {name: text}. As when reading an XML tree
+# tag by tag, the last tag with each name wins; missing fields are left out.
+
+def parseFields(text):
+   fields = {}
+   for field in NFOPatch.findFields(text, fieldNames):
+      fields.update({field['name']: field['value']})
+   return fields
+
+def stamp(path):
+   stat = os.stat(path)
+   return stat.st_size, stat.st_mtime_ns
+
+def recordSize(fields):
+   return 100 + sum(len(value) for value in fields.values())
+
+# Add to one of the two LRU lists, dropping the oldest entries to stay in budget.
+
+def remember(cache, kind, path, entry, size):
+   items = cache[kind]
+   total = kind[:-1] + 'Bytes'
+   if path in items:
+      cache[total] -= items.pop(path)[-1]
+   items.update({path: entry + (size,)})
+   cache[total] += size
+   while (cache[total] > cache['budget']) and (len(items) > 1):
+      cache[total] -= items.popitem(last=False)[1][-1]
+
+# Read an NFO from disk and cache both its text and record.
+
+def load(cache, path, size, mtime):
+   text, encoding = NFOPatch.readNFO(path)
+   fields = parseFields(text)
+   with cache['lock']:
+      cache['reads'] += 1
+      remember(cache, 'docs', path, (size, mtime, text, encoding), len(text))
+      remember(cache, 'records', path, (size, mtime, fields), recordSize(fields))
+      if cache['disk'] is not None:
+         cache['disk'].execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)', (path, size, mtime, json.dumps(fields)))
+   return text, encoding, fields
+
+# The field record for an NFO. size and mtime can be passed in if already
+# known (eg, from NFOScanner) to save checking them again.
+
+def getRecord(cache, path, size=None, mtime=None):
+   if (size is None) or (mtime is None):
+      size, mtime = stamp(path)
+   with cache['lock']:
+      entry = cache['records'].get(path)
+      if (entry is not None) and (entry[0] == size) and (entry[1] == mtime):
+         cache['records'].move_to_end(path)
+         return entry[2]
+      if cache['disk'] is not None:
+         row = cache['disk'].execute('SELECT fields FROM records WHERE path = ? AND size = ? AND mtime = ?', (path, size, mtime)).fetchone()
+         if row is not None:
+            fields = json.loads(row[0])
+            remember(cache, 'records', path, (size, mtime, fields), recordSize(fields))
+            return fields
+   return load(cache, path, size, mtime)[2]
+
+# The text and encoding of an NFO (see NFOPatch.readNFO), for updating it.
+# If it isn't cached already it is just read: the update changes its
+# modified time, so parsing and saving its record would be wasted.
+
+def getDocument(cache, path):
+   size, mtime = stamp(path)
+   with cache['lock']:
+      entry = cache['docs'].get(path)
+      if (entry is not None) and (entry[0] == size) and (entry[1] == mtime):
+         cache['docs'].move_to_end(path)
+         return entry[2], entry[3]
+      cache['reads'] += 1
+   return NFOPatch.readNFO(path)
+
+# Drop an NFO's text once it has been updated (its record is refreshed next
+# time it's asked for, as its modified time will have changed).
+
+def forget(cache, path):
+   with cache['lock']:
+      entry = cache['docs'].pop(path, None)
+      if entry is not None:
+         cache['docBytes'] -= entry[-1]
+
+def closeCache(cache):
+   if cache['disk'] is not None:
+      with cache['lock']:
+         cache['disk'].commit()
+         cache['disk'].close()
@@ -0,0 +1,198 @@
+import os
+import re
+import shutil
+import tempfile
+
+# ############## ABOUT THIS FILE #####################
+#
+# The NFO editor shared by FixFromDB.py and TrimTitle.py. Rather than reading
+# the whole NFO into an XML tree and writing the whole tree back out, it reads
+# through the file once, finds the fields being changed (title, plot, season,
+# episode, lockdata, etc) and swaps out just the text inside those tags.
+# Everything else - the <?xml ...?> declaration (including standalone="yes"),
+# cast lists, fileinfo/streamdetails, spacing, comments - is left exactly
+# as it was, byte for byte.
+#
+# As with the old tree-based edits, every tag with a matching name is changed,
+# wherever it is in the file, and fields that aren't already in the NFO are
+# not added.
+#
+# If every field already has the new value, the NFO is left alone completely:
+# it isn't rewritten and no backup is made.
+#
+# The new NFO is written to a temporary file next to it (.something.nfotmp),
+# flushed to disk and then swapped in, so an interruption can't leave a
+# half-written NFO behind.
+#
+# ###################################################
+
+# One pattern that picks out, in order: comments, CDATA sections, <? ?> and
+# <! > declarations, end tags (group 1 is the name) and start tags (group 2 is
+# the name, group 3 any attributes, group 4 a / if it closes itself).
+
+tokenPattern = re.compile(r'<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>|<![^>]*>'
+                          r'|</\s*([A-Za-z_][\w.\-:]*)\s*>'
+                          r'|<([A-Za-z_][\w.\-:]*)((?:[^>"\'/]|"[^"]*"|\'[^\']*\'|/(?!>))*)(/?)>', re.S)
+encodingPattern = re.compile(rb'^(?:\xef\xbb\xbf)?<\?xml[^>]*encoding\s*=\s*["\']([A-Za-z0-9._\-]+)["\']')
+entityPattern = re.compile(r'&(#[0-9]+|#x[0-9A-Fa-f]+|amp|lt|gt|quot|apos);')
+namedEntities = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+
+# The encoding named in the <?xml ...?> declaration, or utf-8 if there isn't one.
+
+def findEncoding(data):
+   declared = encodingPattern.match(data)
+   if declared is None:
+      return 'utf-8'
+   return declared.group(1).decode('ascii')
+
+def decodeEntity(match):
+   entity = match.group(1)
+   if entity.startswith('#x'):
+      return chr(int(entity[2:], 16))
+   if entity.startswith('#'):
+      return chr(int(entity[1:]))
+   return namedEntities[entity]
+
+# The text of a tag as an XML parser would see it (entities decoded, CDATA
+# unwrapped, comments dropped, line endings as \n).
+
+def readText(raw):
+   parts = []
+   last = 0
+   for match in re.finditer(r'<!--.*?-->|<!\[CDATA\[(.*?)\]\]>', raw, re.S):
+      parts.append(entityPattern.sub(decodeEntity, raw[last:match.start()]))
+      if match.group(1) is not None:
+         parts.append(match.group(1))
+      last = match.end()
+   parts.append(entityPattern.sub(decodeEntity, raw[last:]))
+   return ''.join(parts).replace('\r\n', '\n')
+
+def escapeText(value):
+   return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+# Find every tag named in names. Returns a list of dicts with the tag name,
+# the start and end of the part of the file to replace, whether it's an empty
+# tag that closes itself (<plot />, in which case the span is the whole tag),
+# its attributes, and its current text. As with an XML tree, the text of a tag
+# is the text before its first child tag.
+
+def findFields(text, names):
+   found = []
+   pending = None
+   for token in tokenPattern.finditer(text):
+      endName = token.group(1)
+      startName = token.group(2)
+      if (endName is None) and (startName is None):
+         # comments, CDATA and declarations are part of the text
+         continue
+      if pending is not None:
+         found.append({'name': pending[0], 'start': pending[1], 'end': token.start(), 'selfClosing': False,
+                       'attrs': pending[2], 'value': readText(text[pending[1]:token.start()])})
+         pending = None
+      if (startName is not None) and (startName in names):
+         if token.group(4):
+            found.append({'name': startName, 'start': token.start(), 'end': token.end(), 'selfClosing': True,
+                          'attrs': token.group(3).rstrip(), 'value': ''})
+         else:
+            pending = (startName, token.end(), token.group(3))
+   return found
+
+# Work out the new file contents. fields maps tag names to their new values.
+# Characters the NFO's encoding can't hold are written as &#...; references.
+# Returns the new text, or None if nothing would change.
+
+def patchText(text, fields, encoding='utf-8'):
+   pieces = []
+   last = 0
+   changed = False
+   for field in findFields(text, fields):
+      value = fields[field['name']]
+      if value is None:
+         value = ''
+      value = str(value)
+      if value.replace('\r\n', '\n') == field['value']:
+         continue
+      changed = True
+      value = escapeText(value).encode(encoding, 'xmlcharrefreplace').decode(encoding)
+      pieces.append(text[last:field['start']])
+      if field['selfClosing']:
+         pieces.append('<' + field['name'] + field['attrs'] + '>' + value + '</' + field['name'] + '>')
+      else:
+         pieces.append(value)
+      last = field['end']
+   if not changed:
+      return None
+   pieces.append(text[last:])
+   return ''.join(pieces)
+
+# Read an NFO as text in its own encoding. surrogateescape keeps any bytes that
+# aren't valid in that encoding, so they are written back exactly as they were.
+
+def readNFO(path):
+   with open(path, 'rb') as nfo:
+      data = nfo.read()
+   encoding = findEncoding(data)
+   return data.decode(encoding, 'surrogateescape'), encoding
+
+# Replace the file at path with data: write a temporary file in the same
+# folder, make sure it's on disk, then rename it over the original.
+
+def atomicWrite(path, data):
+   handle, tempPath = tempfile.mkstemp(prefix='.', suffix='.nfotmp', dir=os.path.dirname(os.path.abspath(path)))
+   try:
+      with os.fdopen(handle, 'wb') as temp:
+         temp.write(data)
+         temp.flush()
+         os.fsync(temp.fileno())
+      shutil.copymode(path, tempPath)
+      os.replace(tempPath, path)
+   except BaseException:
+      if os.path.exists(tempPath):
+         os.remove(tempPath)
+      raise
+
+# The NFO's bytes as they are on disk, from its text. Encoding the text again
+# gives back the same bytes, except that a UTF-16/32 file could come back with
+# a different byte order, so those are read again.
+
+def originalBytes(path, text, encoding):
+   if encoding.lower().replace('_', '-').startswith(('utf-16', 'utf16', 'utf-32', 'utf32')):
+      with open(path, 'rb') as nfo:
+         return nfo.read()
+   return text.encode(encoding, 'surrogateescape')
+
+# Update the fields of one NFO. Backs up the original first: backup True makes
+# a .bak copy, or backup can be a function taking the path and the original
+# bytes (see BackupStore.py); False or None for no backup.
+# onStep, if given, is called with 'backedup', 'committed' or 'unchanged' as
+# each step finishes (see RunJournal.py). document is the NFO's (text,
+# encoding) if it has already been read (see NFOCache.py). onSaved, if given,
+# is called with the NFO's bytes as they now are on disk (written, or left
+# as they were), so they needn't be read again (see RunManifest.markDone).
+# Returns True if the NFO was changed, False if it already had these values.
+
+def patchNFO(path, fields, backup=True, onStep=None, document=None, onSaved=None):
+   if document is None:
+      document = readNFO(path)
+   text, encoding = document
+   newText = patchText(text, fields, encoding)
+   if newText is None:
+      if onStep is not None:
+         onStep('unchanged')
+      if onSaved is not None:
+         onSaved(originalBytes(path, text, encoding))
+      return False
+   if backup is True:
+      shutil.copyfile(path, str(path) + '.bak')
+   elif backup:
+      backup(path, originalBytes(path, text, encoding))
+   if backup:
+      if onStep is not None:
+         onStep('backedup')
+   newData = newText.encode(encoding, 'surrogateescape')
+   atomicWrite(path, newData)
+   if onStep is not None:
+      onStep('committed')
+   if onSaved is not None:
+      onSaved(newData)
+   return True
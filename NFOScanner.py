@@ -0,0 +1,96 @@
+import os
+import re
+import fnmatch
+
+# ############## ABOUT THIS FILE #####################
+#
+# The directory scanner shared by FixFromDB.py and TrimTitle.py. It walks the
+# show folder with os.scandir and hands back each NFO as soon as it is found,
+# rather than listing the whole tree first, which matters on slow network
+# shares. The file size and modified time from the directory listing are kept
+# with each NFO (on Windows and SMB shares they come with the listing for free).
+#
+# SKIPPED FILES AND FOLDERS
+# season.nfo and tvshow.nfo are always skipped. Folders matching any of the
+# excludeDirs rules are skipped along with everything in them. A rule is either:
+# - a wildcard pattern matched against the folder name, ignoring case,
+#   eg '.actors', 'extras', '*backup*'
+# - 're:' followed by a regex searched for in the folder's path under the
+#   show folder (with / separators), eg 're:^Season 00$', 're:/old/'
+#
+# ###################################################
+
+skipNames = ['season.nfo', 'tvshow.nfo']
+
+# True if the folder name (or its path under the show folder) matches a rule.
+
+def isExcluded(name, relPath, excludeDirs):
+   for rule in excludeDirs:
+      if rule.startswith('re:'):
+         if re.search(rule[3:], relPath):
+            return True
+      elif fnmatch.fnmatch(name.lower(), rule.lower()):
+         return True
+   return False
+
+# Yield a record for every file under filepath ending in filetype, as it is
+# found: filename, root (its folder), path, size and mtime (nanoseconds).
+# Folders are visited in the same order as os.walk (a folder's files, then its
+# subfolders). Folders that can't be read are reported and skipped.
+
+def scanNFOs(filepath, filetype, excludeDirs=()):
+   filetype = filetype.lower()
+   pending = [(filepath, '')]
+   while pending:
+      root, relRoot = pending.pop()
+      subdirs = []
+      try:
+         with os.scandir(root) as entries:
+            for entry in entries:
+               if entry.is_dir():
+                  relPath = relRoot + '/' + entry.name if relRoot else entry.name
+                  if (not entry.is_symlink()) and (not isExcluded(entry.name, relPath, excludeDirs)):
+                     subdirs.append((entry.path, relPath))
+               elif entry.name.lower().endswith(filetype):
+                  if entry.name.lower() in skipNames:
+                     continue
+                  try:
+                     stat = entry.stat()
+                  except OSError:
+                     # deleted or moved since the folder was listed
+                     continue
+                  yield {"filename": entry.name, "root": root, "path": os.path.join(root, entry.name),
+                         "size": stat.st_size, "mtime": stat.st_mtime_ns}
+      except OSError as error:
+         print("Could not read folder " + str(root) + ": " + str(error))
+         continue
+      # reversed so the first subfolder comes off the end of pending first
+      pending.extend(reversed(subdirs))
+
+# The record scanNFOs would give for one file, or None if it's gone.
+
+def statNFO(path):
+   try:
+      stat = os.stat(path)
+   except OSError:
+      return None
+   return {"filename": os.path.basename(path), "root": os.path.dirname(path), "path": path,
+           "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+# True if scanNFOs(filepath, filetype, excludeDirs) would pick up the file at
+# path (for files reported one at a time, see NFOWatch.py).
+
+def isWanted(path, filepath, filetype, excludeDirs=()):
+   name = os.path.basename(path)
+   if (not name.lower().endswith(filetype.lower())) or (name.lower() in skipNames):
+      return False
+   relPath = os.path.relpath(os.path.dirname(path), filepath).replace(os.sep, '/')
+   if relPath == '.':
+      return True
+   if relPath.startswith('..'):
+      return False
+   parts = relPath.split('/')
+   for n in range(len(parts)):
+      if isExcluded(parts[n], '/'.join(parts[:n + 1]), excludeDirs):
+         return False
+   return True
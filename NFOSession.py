@@ -0,0 +1,253 @@
+import io
+import os
+import json
+import importlib
+import contextlib
+import NFOCache
+import NFOTransform
+import BackupStore
+import EpisodeCatalog
+
+# ############## ABOUT THIS FILE #####################
+#
+# Lets other Python code (a scheduler, a web service, main.py) use
+# FixFromDB.py and TrimTitle.py as a library, running any number of jobs in
+# one process without loading everything again for each:
+#
+#   import NFOSession
+#   with NFOSession.Session('FixFromDB', {'dataFile': 'c:\\data\\show.csv', 'searchMethod': 2}) as session:
+#      result = session.run({'showroot': 'c:\\tv\\Show'})
+#      result = session.run({'showroot': 'c:\\tv\\Show (2019)'})
+#
+# Settings use the same names as the user variables in the scripts; anything
+# not set keeps the value in the script. A session keeps, between jobs:
+# - the episode data (the catalog, or the CSV), opened once and opened again
+#   only if the CSV or the settings that shape it change;
+# - the title index/key index built for matching (see makeMatchSetup);
+# - the compiled filters and patterns;
+# - the NFO cache (see NFOCache.py).
+#
+# The steps can also be run one at a time, each returning its results:
+#   scan()            the NFOs under showroot, as dicts (path, filename, matchname...)
+#   match(nfos)       FixFromDB only: a MatchRecord for each NFO (see MatchTools.py)
+#   review(matches)   FixFromDB only: approves the matches (with reviewMode;
+#                     use 'auto' when nobody is there to answer), returning
+#                     {'accepted': [...], 'declined': [...]}
+#   apply(items)      updates the NFOs, returning {'updated', 'unchanged', 'failed'
+#                     (counts, as in the scripts' summaries), 'errors': [(path,
+#                     error)] for the failed NFOs, 'backup': backup file or None}
+#   log(matches)      writes the _Skipped.txt and _Matched.csv logs to infoDir
+#   run(settings)     all of the above for one job, returning a summary
+#
+# Each apply (and so each run) saves its backups in a backup file of its
+# own (see BackupStore.py). Sessions don't keep the incrementalRun record or
+# the journal; those belong to running the scripts themselves.
+#
+# The scripts keep their settings and state at module level, so a process
+# can only use one session at a time (each session puts its own settings back
+# in place at the start of every step, so taking turns is fine). To run jobs
+# side by side, use a process for each, as BatchRun.py does. quiet=True hides
+# the scripts' printed messages.
+#
+# ###################################################
+
+# The value each setting had in the script before any session changed it.
+baselines = {}
+
+class Session:
+   def __init__(self, tool='FixFromDB', settings=None, quiet=False):
+      if tool not in ['FixFromDB', 'TrimTitle']:
+         raise ValueError("Unknown tool '" + str(tool) + "', please use FixFromDB or TrimTitle.")
+      self.tool = tool
+      self.script = importlib.import_module(tool)
+      self.settings = {}
+      self.quiet = quiet
+      self.cache = None
+      self.data = None
+      self.dataKey = None
+      self.setup = None
+      self.setupKey = None
+      self.patterns = None
+      self.patternKey = None
+      self.update(settings or {})
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *details):
+      self.close()
+
+   # Change some of the session's settings (a dict of name: value).
+
+   def update(self, settings):
+      for name in settings:
+         if (not hasattr(self.script, name)) or callable(getattr(self.script, name)):
+            raise ValueError("Unknown setting '" + name + "', please check the name and try again.")
+      self.settings.update(settings)
+
+   # Put this session's settings (and state) in place in the script.
+
+   def activate(self):
+      baseline = baselines.setdefault(self.tool, {})
+      for name in self.settings:
+         if name not in baseline:
+            baseline.update({name: getattr(self.script, name)})
+      values = dict(baseline)
+      values.update(self.settings)
+      self.script.configure(values)
+      if self.cache is None:
+         if (self.tool == 'FixFromDB') and (self.script.useDiskCache == 1):
+            self.cache = NFOCache.openCache(self.script.cacheBudgetMB, self.script.infoDir)
+         elif self.tool == 'FixFromDB':
+            self.cache = NFOCache.openCache(self.script.cacheBudgetMB)
+         else:
+            self.cache = NFOCache.openCache()
+      self.script.nfoCache = self.cache
+      self.script.manifest = None
+      self.script.metrics = None
+      if self.tool == 'FixFromDB':
+         self.script.journal = None
+
+   def output(self):
+      if self.quiet:
+         return contextlib.redirect_stdout(io.StringIO())
+      return contextlib.nullcontext()
+
+   # The episode data, opened the first time and again only when the CSV or
+   # the settings it depends on change.
+
+   def episodeData(self):
+      script = self.script
+      stat = os.stat(script.dataFile)
+      key = json.dumps([script.dataFile, stat.st_size, stat.st_mtime_ns, script.useCatalog, script.catalogColumns,
+                        script.showName, script.infoDir])
+      if key != self.dataKey:
+         self.closeData()
+         if script.useCatalog == 1:
+            self.data = script.openEpisodeData(script.dataFile)
+         else:
+            # the script fills its own userData list; the session keeps it
+            script.userData = []
+            script.makeEpisodeList(script.dataFile)
+            self.data = script.userData
+            script.userData = []
+         self.dataKey = key
+      return self.data
+
+   def matchSetup(self, db):
+      script = self.script
+      key = json.dumps([self.dataKey, script.searchMethod, script.matchKey, script.scorerBackend, script.scoreCutoff,
+                        script.useTitleIndex, script.indexThreshold, script.indexFallback, script.matchWorkers])
+      if key != self.setupKey:
+         self.closeSetup()
+         self.setup = script.makeMatchSetup(db, script.searchMethod)
+         self.setupKey = key
+      return self.setup
+
+   def closeSetup(self):
+      if self.setup is not None:
+         self.script.closeMatchSetup(self.setup)
+      self.setup = None
+      self.setupKey = None
+
+   def closeData(self):
+      self.closeSetup()
+      if isinstance(self.data, EpisodeCatalog.CatalogView):
+         EpisodeCatalog.closeCatalog(self.data.catalog)
+      self.data = None
+      self.dataKey = None
+
+   # The NFOs under showroot (or the session's showroot), as dicts.
+
+   def scan(self, showroot=None):
+      self.activate()
+      script = self.script
+      root = script.showroot if showroot is None else showroot
+      with self.output():
+         if self.tool == 'TrimTitle':
+            script.nfoData = []
+            script.makeNFOTrimList(root, '.nfo')
+            nfos = script.nfoData
+            script.nfoData = []
+            return nfos
+         key = json.dumps([script.fileFilter1, script.fileFilter2, script.fileFilter3, script.matchKey, script.keyPatterns[script.matchKey]])
+         if key != self.patternKey:
+            self.patterns = script.makePatterns()
+            self.patternKey = key
+         return list(script.extractNFOs(root, '.nfo', script.searchMethod, None, self.patterns))
+
+   def match(self, nfos):
+      if self.tool != 'FixFromDB':
+         raise ValueError("Only FixFromDB matches NFOs to episode data.")
+      self.activate()
+      with self.output():
+         db = self.episodeData()
+         return self.script.matchNFOs(nfos, db, self.script.searchMethod, self.matchSetup(db))
+
+   def review(self, matches):
+      if self.tool != 'FixFromDB':
+         raise ValueError("Only FixFromDB has matches to review.")
+      self.activate()
+      script = self.script
+      with self.output():
+         if script.searchMethod == 1:
+            script.userAccept(matches)
+      declined = [ea for ea in matches if script.isDeclined(ea, script.searchMethod)]
+      accepted = [ea for ea in matches if not script.isDeclined(ea, script.searchMethod)]
+      return {'accepted': accepted, 'declined': declined}
+
+   # Update the NFOs in items: matches from review (FixFromDB) or NFOs from
+   # scan (TrimTitle).
+
+   def apply(self, items):
+      self.activate()
+      script = self.script
+      store = BackupStore.openStore(script.infoDir, self.tool)
+      with self.output():
+         engine = NFOTransform.openEngine(script.makeTransforms(), self.cache, BackupStore.backupMethod(script.backupMode, store))
+         report = NFOTransform.applyAll(engine, items, script.applyWorkers, script.applyShareLimit, script.applyRetries)
+         BackupStore.closeStore(store)
+      return {'updated': report['counts'].get(True, 0), 'unchanged': report['counts'].get(False, 0), 'failed': len(report['errors']),
+              'errors': report['errors'], 'backup': store['path'] if store['conn'] is not None else None}
+
+   # Write the skipped log and update table for reviewed matches.
+
+   def log(self, matches):
+      self.activate()
+      with self.output():
+         for ea in self.script.logStream(matches, self.script.searchMethod, 0):
+            pass
+
+   # Run one job: scan, match, review and apply (and write the logs, with
+   # writeLogs). settings change the session's settings for this job and
+   # the ones after it. Returns a summary of the job.
+
+   def run(self, settings=None, writeLogs=True):
+      self.update(settings or {})
+      nfos = self.scan()
+      summary = {'scanned': len(nfos)}
+      if self.tool == 'TrimTitle':
+         summary.update(self.apply(nfos))
+         return summary
+      reviewed = self.review(self.match(nfos))
+      if writeLogs:
+         self.log(reviewed['accepted'] + reviewed['declined'])
+      items = reviewed['accepted']
+      if self.script.trimTitles == 1:
+         # declined NFOs still get their titles trimmed
+         items = items + reviewed['declined']
+      summary.update({'matched': len(reviewed['accepted']), 'skipped': len(reviewed['declined'])})
+      summary.update(self.apply(items))
+      return summary
+
+   # Close the episode data and cache, and put back the script's own values
+   # for the settings this session changed.
+
+   def close(self):
+      self.closeData()
+      if self.cache is not None:
+         NFOCache.closeCache(self.cache)
+      self.cache = None
+      baseline = baselines.get(self.tool, {})
+      self.script.configure({name: baseline[name] for name in self.settings if name in baseline})
+      self.script.nfoCache = None if self.tool == 'FixFromDB' else NFOCache.openCache()
@@ -0,0 +1,129 @@
+import re
+import NFOPatch
+import NFOScanner
+import NFOApply
+import NFOCache
+import RunManifest
+import RunJournal
+import MatchTools
+
+# ############## ABOUT THIS FILE #####################
+#
+# The update step shared by FixFromDB.py and TrimTitle.py. What a tool does to
+# an NFO is a list of transforms, each adding the new values of some fields:
+#
+# - trimTitle:   the title from the NFO's filename, with the filters taken out
+#                and appendTerm added on the end (TrimTitle.py, or FixFromDB.py
+#                with trimTitles set to 1);
+# - catalogFill: season, episode, title, plot, etc from the matched CSV row
+#                (FixFromDB.py);
+# - lockData:    <lockdata>true</lockdata>, if anything else is being changed
+#                (both, with setLockdata set to 1).
+#
+# The transforms are applied in order, so a later one wins where two set the
+# same field (eg, trimTitle after catalogFill replaces the CSV's title).
+# However many transforms there are, each NFO is read once (see NFOCache.py),
+# backed up once and written once, with only the changed fields rewritten
+# (see NFOPatch.py). So FixFromDB.py with trimTitles does the work of running
+# both tools on a show in a single pass.
+#
+# ###################################################
+
+catalogFields = ['season', 'episode', 'title', 'plot', 'year', 'runtime', 'imdbid', 'tvdbid']
+
+# A transform is a function taking an NFO's record (from NFOScanner or
+# FixFromDB.py) and the fields worked out so far, which it adds to.
+
+# The filename, with filters (compiled patterns) taken out and appendTerm
+# added, as the new title.
+
+def trimmedName(filename, filters, appendTerm=''):
+   newname = str(filename)
+   for myFilter in filters:
+      newname = myFilter.sub('', newname)
+   newname = newname.replace('.nfo', '')
+   return newname + appendTerm
+
+def trimTitle(filters, appendTerm=''):
+   # compile the filters once for the whole run
+   myFilters = [re.compile(myFilter) for myFilter in filters]
+
+   def transform(ea, fields):
+      fields.update({'title': trimmedName(ea['filename'], myFilters, appendTerm)})
+
+   return transform
+
+def catalogFill(ea, fields):
+   if isinstance(ea, MatchTools.MatchRecord):
+      ea = ea.asRow()
+   for item in catalogFields:
+      if item in ea:
+         fields.update({item: ea[item]})
+
+def lockData(ea, fields):
+   if len(fields) > 0:
+      fields.update({'lockdata': 'true'})
+
+# The fields planned in a journal (RunJournal.unfinishedEntries), as they were.
+
+def replayFields(ea, fields):
+   for item, value in ea.items():
+      if item != 'path':
+         fields.update({item: value})
+
+# Set up the update step. backup is as for patchNFO (see BackupStore.py),
+# journal and manifest are optional, and isDone, if given, says which NFOs
+# to mark as done in the manifest (all of them otherwise). written, if given,
+# is a dict the size and modified time of each NFO are noted in just after
+# it's done (for watch mode, see NFOWatch.py).
+
+def openEngine(transforms, cache, backup=False, journal=None, manifest=None, isDone=None, written=None):
+   return {'transforms': transforms, 'cache': cache, 'backup': backup, 'journal': journal,
+           'manifest': manifest, 'isDone': isDone, 'written': written}
+
+def planFields(engine, ea):
+   fields = {}
+   for transform in engine['transforms']:
+      transform(ea, fields)
+   return fields
+
+# Update one NFO: read, back up and write it once for every transform,
+# logging each step in the journal. Returns True if the NFO was changed.
+
+def applyOne(engine, ea):
+   path = ea['path']
+   fields = planFields(engine, ea)
+   document = NFOCache.getDocument(engine['cache'], path)
+   journal = engine['journal']
+   manifest = engine['manifest']
+   if (manifest is not None) and ((engine['isDone'] is None) or engine['isDone'](ea)):
+      # the manifest hashes the bytes written, rather than reading the NFO back
+      saved = lambda data: RunManifest.markDone(manifest, path, data)
+   else:
+      saved = None
+   if journal is None:
+      changed = NFOPatch.patchNFO(path, fields, engine['backup'], document=document, onSaved=saved)
+   else:
+      backup = engine['backup']
+      if RunJournal.wasBackedUp(journal, path):
+         backup = False
+      if not RunJournal.isPlanned(journal, path):
+         RunJournal.record(journal, path, 'planned', fields)
+      changed = NFOPatch.patchNFO(path, fields, backup, lambda state: RunJournal.record(journal, path, state), document, saved)
+   NFOCache.forget(engine['cache'], path)
+   if engine['written'] is not None:
+      nfo = NFOScanner.statNFO(path)
+      if nfo is not None:
+         engine['written'].update({path: (nfo['size'], nfo['mtime'])})
+   return changed
+
+# Update every NFO in items, several at once (see NFOApply.py). Returns the
+# NFOApply report.
+
+def applyAll(engine, items, workers=4, perShare=4, retries=3):
+   if (engine['journal'] is not None) and isinstance(items, list):
+      RunJournal.recordPlans(engine['journal'], items, lambda ea: planFields(engine, ea))
+   report = NFOApply.applyConcurrently(items, lambda ea: applyOne(engine, ea), workers, perShare, retries)
+   print(str(report['counts'].get(True, 0)) + " NFOs updated, " + str(report['counts'].get(False, 0)) + " already up to date.")
+   NFOApply.reportErrors(report)
+   return report
@@ -0,0 +1,152 @@
+import os
+import time
+import threading
+from datetime import datetime
+import NFOScanner
+
+# ############## ABOUT THIS FILE #####################
+#
+# Watch mode for FixFromDB.py and TrimTitle.py (run either with --watch).
+# Instead of scanning the whole show folder on a schedule, the script keeps
+# running and fixes NFOs as the media server writes them.
+#
+# - At the start, the whole folder is done once as in a normal run (with
+#   incrementalRun, only NFOs that are new or changed since the last run).
+# - After that, only NFOs that are added or changed are looked at. If the
+#   watchdog package is installed (pip install watchdog), the folder is
+#   watched for changes (inotify on Linux); otherwise, or with watchPolling
+#   set to 1, it is scanned every watchPollInterval seconds. Use polling for
+#   network shares, where change notifications from other machines often
+#   don't come through.
+# - Changes come in bursts (eg, a whole season refreshed at once), so NFOs
+#   are collected until there have been no new changes for watchDelay
+#   seconds (or for at most ten times that), then done together.
+# - The CSV/catalog, title index and patterns are loaded once and stay in
+#   memory between batches.
+# - The size and modified time of every NFO are noted just after it's been
+#   done, so the script's own updates (and anything else that leaves an NFO
+#   as it was) don't set it off again, while the media server changing it
+#   later in the same batch still does.
+# - Watching starts before the first full pass, so NFOs written while it
+#   runs (which can take minutes on a big library) aren't missed.
+#
+# Stop it with Ctrl+C.
+#
+# ###################################################
+
+# Start watching filepath for changes with watchdog, calling onChange(path)
+# for each. Returns the running observer, or None if watchdog isn't installed.
+
+def startObserver(filepath, filetype, onChange):
+   try:
+      from watchdog.observers import Observer
+      from watchdog.events import FileSystemEventHandler
+   except ImportError:
+      return None
+
+   class ChangeHandler(FileSystemEventHandler):
+      def on_any_event(self, event):
+         if event.is_directory:
+            return
+         for path in [event.src_path, getattr(event, 'dest_path', None)]:
+            if path and str(path).lower().endswith(filetype.lower()):
+               onChange(os.fsdecode(path))
+
+   observer = Observer()
+   observer.schedule(ChangeHandler(), filepath, recursive=True)
+   observer.start()
+   return observer
+
+# Size and modified time of every NFO scanNFOs finds, by path.
+
+def snapshot(filepath, filetype, excludeDirs):
+   return {nfo['path']: (nfo['size'], nfo['mtime']) for nfo in NFOScanner.scanNFOs(filepath, filetype, excludeDirs)}
+
+# Do one batch with handleBatch (a function taking a list of NFOScanner
+# records). Unless noted (handleBatch notes each NFO in handled itself, as
+# it's done), how each NFO was left is noted in handled once the batch ends.
+
+def doBatch(handleBatch, nfos, handled, noted=False):
+   print("\n" + datetime.now().strftime("%Y-%m-%d %H:%M:%S") + ": " + str(len(nfos)) + " new or changed NFOs.")
+   try:
+      handleBatch(nfos)
+   except Exception as error:
+      # keep watching; these NFOs are looked at again the next time they change
+      print("Could not finish this batch: " + type(error).__name__ + ": " + str(error))
+      return
+   if noted:
+      return
+   for nfo in nfos:
+      after = NFOScanner.statNFO(nfo['path'])
+      if after is not None:
+         handled.update({nfo['path']: (after['size'], after['mtime'])})
+
+# Run handleBatch on every NFO under filepath, then on NFOs as they change,
+# until stopped with Ctrl+C. handled: a dict of path: (size, mtime) that
+# handleBatch fills in as it does each NFO (see NFOTransform.openEngine); if
+# not given, the NFOs are looked at when each batch ends instead.
+
+def watchFolder(filepath, filetype, excludeDirs, handleBatch, delay=5, pollInterval=60, polling=0, handled=None):
+   noted = handled is not None
+   if not noted:
+      handled = {}
+   pending = {}
+   lock = threading.Lock()
+
+   def onChange(path):
+      with lock:
+         pending.update({path: time.time()})
+
+   # start watching before the first pass, which can take minutes on a big
+   # library, so NFOs written meanwhile aren't missed (the script's own
+   # updates are filtered out with handled, as usual)
+   observer = None
+   if polling != 1:
+      observer = startObserver(filepath, filetype, onChange)
+   nfos = list(NFOScanner.scanNFOs(filepath, filetype, excludeDirs))
+   if observer is None:
+      # the first poll compares against the NFOs as they were found, so any
+      # changed during the first pass are picked up
+      known = {nfo['path']: (nfo['size'], nfo['mtime']) for nfo in nfos}
+   lastPoll = time.time()
+   if len(nfos) > 0:
+      doBatch(handleBatch, nfos, handled, noted)
+   if observer is None:
+      print("\nChecking " + str(filepath) + " for new or changed NFOs every " + str(pollInterval) + " seconds. Ctrl+C to stop.")
+   else:
+      print("\nWatching " + str(filepath) + " for new or changed NFOs. Ctrl+C to stop.")
+   try:
+      while True:
+         time.sleep(min(1, delay))
+         now = time.time()
+         if (observer is None) and (now - lastPoll >= pollInterval):
+            current = snapshot(filepath, filetype, excludeDirs)
+            for path, stamp in current.items():
+               if known.get(path) != stamp:
+                  onChange(path)
+            known = current
+            lastPoll = now
+         with lock:
+            if len(pending) == 0:
+               continue
+            if (now - max(pending.values()) < delay) and (now - min(pending.values()) < delay * 10):
+               continue
+            paths = list(pending)
+            pending.clear()
+         nfos = []
+         for path in paths:
+            if not NFOScanner.isWanted(path, filepath, filetype, excludeDirs):
+               continue
+            nfo = NFOScanner.statNFO(path)
+            # gone again, or just as the script (or an earlier batch) left it
+            if (nfo is None) or (handled.get(path) == (nfo['size'], nfo['mtime'])):
+               continue
+            nfos.append(nfo)
+         if len(nfos) > 0:
+            doBatch(handleBatch, nfos, handled, noted)
+   except KeyboardInterrupt:
+      print("\nStopped watching.")
+   finally:
+      if observer is not None:
+         observer.stop()
+         observer.join()
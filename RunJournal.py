@@ -0,0 +1,134 @@
+import os
+import json
+import threading
+
+# ############## ABOUT THIS FILE #####################
+#
+# A running log ("journal") of the NFO update step of FixFromDB.py, so that
+# if a run is interrupted part way through (crash, power cut, lost network),
+# it can be finished off without matching and approving everything again.
+#
+# Before any NFO is touched, the planned changes for the whole run are
+# written to FixFromDB_journal.jsonl in infoDir (in streamMode, each NFO's
+# just before it is updated). Each step is then logged as it
+# completes: backedup (original backed up), committed (new NFO in place)
+# or unchanged (nothing to do). Every line is flushed to disk before the
+# step it describes goes ahead, and the NFO itself is written to a temporary
+# file and swapped in (see atomicWrite in NFOPatch.py), so an NFO is always
+# either the old version or the new one, never half written.
+#
+# When a run finishes with every NFO done, the journal is deleted. If it's
+# still there, the last run didn't finish: run FixFromDB.py --resume (or set
+# journalResume to 1) to redo only the unfinished NFOs. NFOs that were
+# already backed up are not backed up again, so the interrupted run's backup
+# (or .bak) still holds the original. A normal run won't start while an
+# unfinished journal is waiting, so .bak files can't be overwritten by
+# accident. NFOs that still can't be updated on resume are logged as failed
+# and listed.
+#
+# ###################################################
+
+journalFile = 'FixFromDB_journal.jsonl'
+doneStates = ['committed', 'unchanged', 'failed']
+
+# Read a journal into a dict of path: {'state': last state, 'fields': planned
+# changes, 'backedUp': True if it was backed up since it was last finished}.
+# backedUp isn't lost when a resumed run plans the NFO again and then dies
+# too, so however many times a run is resumed the original is only backed up
+# once (a second backup could be of the NFO already changed).
+
+def loadJournal(path):
+   entries = {}
+   if not os.path.exists(path):
+      return entries
+   with open(path, encoding='utf-8') as file:
+      for line in file:
+         try:
+            step = json.loads(line)
+         except ValueError:
+            # the last line may be cut short if the run died while writing it
+            continue
+         entry = entries.setdefault(step['path'], {'state': None, 'fields': {}, 'backedUp': False})
+         entry.update({'state': step['state']})
+         if step['state'] == 'backedup':
+            entry.update({'backedUp': True})
+         elif step['state'] in doneStates:
+            entry.update({'backedUp': False})
+         if step.get('fields') is not None:
+            entry.update({'fields': step['fields']})
+   return entries
+
+# Open the journal in folder, picking up any unfinished entries from last time.
+
+def openJournal(folder):
+   path = folder + journalFile
+   previous = loadJournal(path)
+   unfinished = {}
+   for nfoPath, entry in previous.items():
+      if entry['state'] not in doneStates:
+         unfinished.update({nfoPath: entry})
+   journal = {'path': path, 'lock': threading.Lock(), 'previous': unfinished, 'open': set()}
+   journal.update({'file': open(path, 'a', encoding='utf-8')})
+   return journal
+
+# Unfinished NFOs from the last run, in the form nfoEdits takes (path plus fields).
+
+def unfinishedEntries(journal):
+   entries = []
+   for nfoPath, entry in journal['previous'].items():
+      ea = dict(entry['fields'])
+      ea.update({'path': nfoPath})
+      entries.append(ea)
+   return entries
+
+# True if an earlier run (the last, or one resumed before it) already backed
+# this NFO up.
+
+def wasBackedUp(journal, path):
+   entry = journal['previous'].get(path)
+   return (entry is not None) and entry['backedUp']
+
+# Log one step for one NFO, and make sure it's on disk before carrying on.
+# Safe to call from the update threads.
+
+def record(journal, path, state, fields=None):
+   step = {'path': path, 'state': state}
+   if fields is not None:
+      step.update({'fields': fields})
+   with journal['lock']:
+      journal['file'].write(json.dumps(step) + '\n')
+      journal['file'].flush()
+      os.fsync(journal['file'].fileno())
+      if state in doneStates:
+         journal['open'].discard(path)
+         journal['previous'].pop(path, None)
+      else:
+         journal['open'].add(path)
+
+# Log the planned changes for a whole list of NFOs up front (one flush to
+# disk for all of them), so the journal knows about every NFO in the run
+# before any are touched. fields is a function giving the changes for one.
+
+def recordPlans(journal, entries, fields):
+   with journal['lock']:
+      for ea in entries:
+         journal['file'].write(json.dumps({'path': ea['path'], 'state': 'planned', 'fields': fields(ea)}) + '\n')
+         journal['open'].add(ea['path'])
+      journal['file'].flush()
+      os.fsync(journal['file'].fileno())
+
+# True if this NFO's changes are already in the journal for this run.
+
+def isPlanned(journal, path):
+   with journal['lock']:
+      return path in journal['open']
+
+# Close the journal, deleting it if everything was finished.
+
+def closeJournal(journal):
+   journal['file'].close()
+   unfinished = journal['open'] | set(journal['previous'])
+   if len(unfinished) == 0:
+      os.remove(journal['path'])
+   else:
+      print("\n" + str(len(unfinished)) + " NFO updates did not finish. Run again with --resume to finish them.")
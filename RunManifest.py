@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+
+# ############## ABOUT THIS FILE #####################
+#
+# Remembers which NFOs FixFromDB.py and TrimTitle.py have already fixed, so
+# that a nightly run only has to look at NFOs that are new or have changed
+# since. The record is a small SQLite database (NFO_manifest.sqlite) in
+# infoDir, with one row per NFO per tool: its size, modified time and a hash
+# of its contents after it was fixed, plus a hash of the CSV and of the
+# settings (filters, patterns, columns, etc) it was fixed with.
+#
+# An NFO is skipped if it is in the record for the same CSV and settings and
+# its size and modified time are unchanged (or, if only the modified time has
+# changed, its contents are). Changing the CSV or settings makes every NFO
+# count as new again. Only NFOs that were actually fixed (or already correct)
+# are recorded - declined and unmatched NFOs are looked at again next time.
+#
+# To process everything regardless, set fullRun to 1 or run the script with
+# --full (eg, python FixFromDB.py --full).
+#
+# ###################################################
+
+manifestFile = 'NFO_manifest.sqlite'
+
+def hashFile(path):
+   digest = hashlib.sha256()
+   with open(path, 'rb') as file:
+      for block in iter(lambda: file.read(1024 * 1024), b''):
+         digest.update(block)
+   return digest.hexdigest()
+
+# A hash of the settings that affect what a run does (a dict of user variables).
+
+def configVersion(settings):
+   return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+# Open (or create) the record in folder. catalog and config are the CSV and
+# settings hashes for this run. full: 1 to process every NFO (they are still
+# recorded).
+
+def openManifest(folder, tool, catalog, config, full=0):
+   conn = sqlite3.connect(folder + manifestFile, check_same_thread=False)
+   conn.execute('CREATE TABLE IF NOT EXISTS files (tool TEXT, path TEXT, size INTEGER, mtime INTEGER, hash TEXT, '
+                'catalog TEXT, config TEXT, PRIMARY KEY (tool, path))')
+   conn.commit()
+   return {'conn': conn, 'lock': threading.Lock(), 'tool': tool, 'catalog': catalog, 'config': config,
+           'full': full, 'skipped': 0, 'unsaved': 0}
+
+# True if this NFO (a record from NFOScanner.scanNFOs) can be skipped.
+
+def isUnchanged(manifest, nfo):
+   if manifest['full'] == 1:
+      return False
+   with manifest['lock']:
+      row = manifest['conn'].execute('SELECT size, mtime, hash, catalog, config FROM files WHERE tool = ? AND path = ?',
+                                     (manifest['tool'], nfo['path'])).fetchone()
+   if row is None:
+      return False
+   size, mtime, contentHash, catalog, config = row
+   if (catalog != manifest['catalog']) or (config != manifest['config']) or (size != nfo['size']):
+      return False
+   if mtime != nfo['mtime']:
+      try:
+         if hashFile(nfo['path']) != contentHash:
+            return False
+      except OSError:
+         return False
+   manifest['skipped'] += 1
+   return True
+
+# Record an NFO as fixed, as it is now. data: its contents, if the caller
+# has them (eg just written), so it isn't read again. Safe to call from the
+# update threads.
+
+def markDone(manifest, path, data=None):
+   stat = os.stat(path)
+   if data is None:
+      contentHash = hashFile(path)
+   else:
+      contentHash = hashlib.sha256(data).hexdigest()
+   with manifest['lock']:
+      manifest['conn'].execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (manifest['tool'], path, stat.st_size, stat.st_mtime_ns, contentHash,
+                                manifest['catalog'], manifest['config']))
+      manifest['unsaved'] += 1
+      if manifest['unsaved'] >= 200:
+         manifest['conn'].commit()
+         manifest['unsaved'] = 0
+
+# Save everything recorded so far (for runs that don't end, see NFOWatch.py).
+
+def saveManifest(manifest):
+   with manifest['lock']:
+      manifest['conn'].commit()
+      manifest['unsaved'] = 0
+
+def closeManifest(manifest):
+   with manifest['lock']:
+      manifest['conn'].commit()
+      manifest['conn'].close()
+   if manifest['skipped'] > 0:
+      print(str(manifest['skipped']) + " NFOs unchanged since the last run were skipped (use --full to process everything).")
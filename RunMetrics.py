@@ -0,0 +1,286 @@
+import sys
+import json
+import time
+import cProfile
+import pstats
+import tracemalloc
+import contextlib
+from datetime import datetime
+
+# ############## ABOUT THIS FILE #####################
+#
+# Records where the time goes in a run of FixFromDB.py or TrimTitle.py (with
+# collectMetrics set to 1), so a slow run can be tracked down to its cause.
+# For each step ("phase") of the run it notes:
+#
+# - wall:    seconds from start to finish (including waiting for the NAS, or
+#            for you, in review);
+# - cpu:     seconds of processor time (all threads of the script; not the
+#            matchWorkers processes);
+# - items:   how many NFOs (or CSV rows) the step handled;
+# - read / written: bytes read and written by the script (Linux and Windows);
+# - peakMemoryMB: the most memory the script used during the step (on Linux,
+#            where the peak can be reset as each step starts). Elsewhere this
+#            is peakSoFarMB instead: the most used since the script started, so
+#            steps after the heaviest one show the same figure.
+#
+# The phases are scan (finding the NFOs and cleaning up their filenames),
+# load (the CSV or catalog), match, review (fuzzy matches), extra (the
+# manualSave QA columns), log (the skipped log and update table) and apply
+# (backing up and updating the NFOs). TrimTitle.py has scan and apply.
+#
+# The figures are printed at the end and saved as <date time>_Metrics.json
+# in infoDir, next to the _Matched.csv and _Skipped.txt files, along with the
+# run's summary (matched, skipped, updated...).
+#
+# In streamMode (and watch mode) the steps run together, an NFO at a time, so
+# each step's time is the time spent in that step alone, and bytes and memory
+# are only given for the run as a whole (under "stream").
+#
+# PROFILING
+# Set profilePhase to a phase name (eg 'match') to profile that step as well:
+# the time in each Python function is saved to <date time>_Profile_match.prof
+# (open it with python -m pstats, or a viewer such as snakeviz), the slowest
+# functions and the lines that allocated the most memory are listed in the
+# metrics file, and its peak traced memory is noted. Profiling slows the step
+# down a good deal, so only use it to look into a problem. With matchWorkers
+# above 1, matching happens in other processes and isn't profiled.
+#
+# ###################################################
+
+# Bytes read and written by this process so far, or None where that can't be
+# found out.
+
+def ioCounters():
+   if sys.platform.startswith('linux'):
+      try:
+         with open('/proc/self/io') as file:
+            counters = dict(line.split(':') for line in file if ':' in line)
+         return int(counters['rchar']), int(counters['wchar'])
+      except (OSError, KeyError, ValueError):
+         return None
+   if sys.platform == 'win32':
+      try:
+         import ctypes
+
+         class IOCounters(ctypes.Structure):
+            _fields_ = [(name, ctypes.c_ulonglong) for name in ['reads', 'writes', 'others', 'readBytes', 'writtenBytes', 'otherBytes']]
+
+         counters = IOCounters()
+         ctypes.windll.kernel32.GetProcessIoCounters(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters))
+         return counters.readBytes, counters.writtenBytes
+      except (OSError, AttributeError):
+         return None
+   return None
+
+# The most memory this process has used so far, in MB, or None.
+
+def peakMemoryMB():
+   try:
+      import resource
+   except ImportError:
+      resource = None
+   if resource is not None:
+      peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+      # kilobytes on Linux, bytes on a Mac
+      return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+   try:
+      import ctypes
+
+      class MemoryCounters(ctypes.Structure):
+         _fields_ = [('cb', ctypes.c_ulong), ('pageFaults', ctypes.c_ulong)] + [(name, ctypes.c_size_t) for name in
+                    ['peakWorkingSet', 'workingSet', 'peakPaged', 'paged', 'peakNonPaged', 'nonPaged', 'pagefile', 'peakPagefile']]
+
+      counters = MemoryCounters()
+      counters.cb = ctypes.sizeof(counters)
+      ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb)
+      return round(counters.peakWorkingSet / (1024 * 1024), 1)
+   except (OSError, AttributeError):
+      return None
+
+# Start measuring the peak memory afresh, where the OS allows it (Linux).
+# Returns False if it doesn't.
+
+def resetPeak():
+   if not sys.platform.startswith('linux'):
+      return False
+   try:
+      with open('/proc/self/clear_refs', 'w') as file:
+         file.write('5')
+      return True
+   except OSError:
+      return False
+
+def openMetrics(tool, folder, profile=''):
+   metrics = {'tool': tool, 'folder': folder, 'started': datetime.now(), 'profile': profile, 'phases': {}, 'stack': [],
+              'profiler': None, 'tracing': False, 'tracedPeak': 0, 'allocations': None, 'begin': sample(True)}
+   # the peak before the reset still counts for the run as a whole
+   metrics.update({'runPeak': peakMemoryMB() or 0})
+   metrics.update({'resettable': resetPeak()})
+   return metrics
+
+# Note the peak memory so far against every step still running (and the
+# run), eg before a step inside them resets it.
+
+def notePeak(metrics):
+   peak = peakMemoryMB()
+   if peak is None:
+      return None
+   for frame in metrics['stack']:
+      if frame['full']:
+         frame.update({'peak': max(frame['peak'], peak)})
+   metrics.update({'runPeak': max(metrics['runPeak'], peak)})
+   return peak
+
+# Where the clocks and counters are now. full: include the bytes read and
+# written (which takes a little longer to find out).
+
+def sample(full):
+   now = {'wall': time.perf_counter(), 'cpu': time.process_time()}
+   if full:
+      counters = ioCounters()
+      if counters is not None:
+         now.update({'read': counters[0], 'written': counters[1]})
+   return now
+
+def start(metrics, name, full=True):
+   stack = metrics['stack']
+   if (len(stack) > 0) and stack[-1]['profiling']:
+      metrics['profiler'].disable()
+   frame = {'name': name, 'full': full, 'children': {}, 'profiling': name == metrics['profile'], 'peak': 0}
+   if full and metrics['resettable']:
+      notePeak(metrics)
+      resetPeak()
+   stack.append(frame)
+   if frame['profiling']:
+      if metrics['profiler'] is None:
+         metrics.update({'profiler': cProfile.Profile()})
+      if not metrics['tracing']:
+         tracemalloc.start()
+         metrics.update({'tracing': True})
+   frame.update({'start': sample(full)})
+   if frame['profiling']:
+      metrics['profiler'].enable()
+
+def stop(metrics, name):
+   stack = metrics['stack']
+   frame = stack.pop()
+   if frame['profiling']:
+      metrics['profiler'].disable()
+   end = sample(frame['full'])
+   phase = metrics['phases'].setdefault(name, {'wall': 0, 'cpu': 0, 'items': 0, 'calls': 0})
+   phase['calls'] += 1
+   for key, value in frame['start'].items():
+      if key not in end:
+         continue
+      spent = end[key] - value
+      # time in steps run from inside this one (eg pulling NFOs from the
+      # step before, in streamMode) belongs to those steps
+      phase.update({key: phase.get(key, 0) + spent - frame['children'].get(key, 0)})
+      if len(stack) > 0:
+         stack[-1]['children'].update({key: stack[-1]['children'].get(key, 0) + spent})
+   if frame['full'] and metrics['resettable']:
+      peak = max(frame['peak'], notePeak(metrics) or 0)
+      phase.update({'peakMemoryMB': max(phase.get('peakMemoryMB', 0), peak)})
+   elif frame['full']:
+      phase.update({'peakSoFarMB': peakMemoryMB()})
+   if frame['profiling']:
+      metrics.update({'tracedPeak': max(metrics['tracedPeak'], tracemalloc.get_traced_memory()[1])})
+      if frame['full']:
+         metrics.update({'allocations': tracemalloc.take_snapshot()})
+   if (len(stack) > 0) and stack[-1]['profiling']:
+      metrics['profiler'].enable()
+
+# Time the code inside the with block as phase name. metrics can be None (no
+# metrics being kept). full: False to leave bytes and memory to the phase
+# around it.
+
+@contextlib.contextmanager
+def phase(metrics, name, full=True):
+   if metrics is None:
+      yield
+      return
+   start(metrics, name, full)
+   try:
+      yield
+   finally:
+      # it may have been stopped already by saveMetrics (eg manualSave stopping the run)
+      if (len(metrics['stack']) > 0) and (metrics['stack'][-1]['name'] == name):
+         stop(metrics, name)
+
+def count(metrics, name, items):
+   if metrics is None:
+      return
+   metrics['phases'].setdefault(name, {'wall': 0, 'cpu': 0, 'items': 0, 'calls': 0})['items'] += items
+
+# Time a streamMode step: the time spent getting each item out of entries
+# (a generator) is counted as phase name, and the items are counted.
+
+def timedStream(metrics, name, entries):
+   if metrics is None:
+      return entries
+
+   def timed():
+      iterator = iter(entries)
+      while True:
+         start(metrics, name, False)
+         try:
+            ea = next(iterator)
+         except StopIteration:
+            return
+         finally:
+            stop(metrics, name)
+         count(metrics, name, 1)
+         yield ea
+
+   return timed()
+
+def profileReport(metrics, stamp):
+   destFile = metrics['folder'] + stamp + '_Profile_' + metrics['profile'] + '.prof'
+   metrics['profiler'].dump_stats(destFile)
+   stats = pstats.Stats(metrics['profiler']).stats
+   slowest = sorted(stats.items(), key=lambda item: -item[1][3])[:25]
+   report = {'phase': metrics['profile'], 'file': destFile, 'tracedPeakMB': round(metrics['tracedPeak'] / (1024 * 1024), 1),
+             'topFunctions': [{'function': func[2], 'file': func[0], 'line': func[1], 'calls': stat[1],
+                               'ownSeconds': round(stat[2], 4), 'totalSeconds': round(stat[3], 4)} for func, stat in slowest]}
+   snapshot = metrics['allocations']
+   if snapshot is None:
+      snapshot = tracemalloc.take_snapshot()
+   report.update({'topAllocations': [{'line': str(stat.traceback), 'sizeKB': round(stat.size / 1024, 1), 'blocks': stat.count}
+                                     for stat in snapshot.statistics('lineno')[:15]]})
+   tracemalloc.stop()
+   return report
+
+# Finish the metrics, print them and save them in infoDir. summary is the
+# run's summary (runSummary in the scripts).
+
+def saveMetrics(metrics, summary=None):
+   if metrics is None:
+      return
+   while len(metrics['stack']) > 0:
+      stop(metrics, metrics['stack'][-1]['name'])
+   stamp = metrics['started'].strftime("%Y-%m-%d %H-%M-%S")
+   end = sample(True)
+   results = {'tool': metrics['tool'], 'started': metrics['started'].isoformat(timespec='seconds'),
+              'finished': datetime.now().isoformat(timespec='seconds'), 'wall': round(end['wall'] - metrics['begin']['wall'], 4),
+              'cpu': round(end['cpu'] - metrics['begin']['cpu'], 4), 'peakMemoryMB': max(metrics['runPeak'], notePeak(metrics) or 0)}
+   for key in ['read', 'written']:
+      if key in end:
+         results.update({key: end[key] - metrics['begin'][key]})
+   phases = []
+   for name, phase in metrics['phases'].items():
+      entry = {'phase': name}
+      entry.update({key: (round(value, 4) if isinstance(value, float) else value) for key, value in phase.items()})
+      phases.append(entry)
+   results.update({'phases': phases, 'summary': summary or {}})
+   if metrics['profiler'] is not None:
+      results.update({'profile': profileReport(metrics, stamp)})
+   destFile = metrics['folder'] + stamp + '_Metrics.json'
+   with open(destFile, 'w', encoding='utf-8') as file:
+      json.dump(results, file, indent=1)
+   print("\n" + "PHASE".ljust(10) + "WALL".rjust(10) + "CPU".rjust(10) + "ITEMS".rjust(8) + "READ MB".rjust(10) + "WRITTEN MB".rjust(12))
+   for entry in phases:
+      print(entry['phase'].ljust(10) + ("%.3fs" % entry['wall']).rjust(10) + ("%.3fs" % entry['cpu']).rjust(10) + str(entry['items']).rjust(8)
+            + ("%.2f" % (entry['read'] / 1048576) if 'read' in entry else '-').rjust(10)
+            + ("%.2f" % (entry['written'] / 1048576) if 'written' in entry else '-').rjust(12))
+   print("Timings are saved at " + destFile + ".")
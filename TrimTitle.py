@@ -1,9 +1,13 @@
 ## Tested and working script
 
-import os
-import xml.etree.ElementTree as ET
-import re
-import shutil
+import sys
+import NFOScanner
+import RunManifest
+import NFOCache
+import NFOWatch
+import BackupStore
+import NFOTransform
+import RunMetrics
 
 # ############## ABOUT THIS FILE #####################
 #
@@ -14,7 +18,7 @@ import shutil
 # is not desired to rename the underlying file. Substituting the title in the
 # corresponding NFO (and directing the media server to update from NFOs) will
 # alter the GUI display name without affecting the underlying file.
-# A backup of the original NFO file is also created (filename.bak).
+# The original NFO is backed up first (see BACKUPS below).
 #
 # The NFO files need to all be in a referenced directory (including subdirs).
 # If you have NFOs you don't want touched, you will need to move them out of the tree.
@@ -28,12 +32,14 @@ import shutil
 # I wanted to preserve, and I also didn't want to trigger re-upload to cloud
 # backups. I just wanted to change the display title.
 #
-# .BAK BACKUP FILES
-# Be aware that there is no provision at this stage for preserving existing .bak
-# files. If there are existing .bak files, from an earlier run of this script
-# or for some other reason, they will be overwritten. You will need to rename
-# them or move them out to preserve them (or edit the function nfoTrim to give
-# the new backups a different file extension).
+# BACKUPS
+# NFOs that already have the right title are not rewritten or backed up.
+# The originals of the NFOs that are changed are saved, compressed, in one
+# backup file per run in infoDir (NFO_backup <date time> TrimTitle.sqlite), and
+# the whole run (or just some NFOs) can be put back with BackupStore.py - see
+# backupMode below and BackupStore.py. With backupMode 'bak', a .bak copy is
+# made next to each NFO instead, as in earlier versions; existing .bak files
+# are overwritten, so rename or move them out first to keep them.
 #
 # ###################################################
 
@@ -43,6 +49,52 @@ import shutil
 # escaping for Windows: "c:\\python\\test", "\\\\192.168.1.30\\test\\Forensic Files"
 showroot = ""
 
+# Folders under showroot to leave out entirely, eg extras or backup folders.
+# Wildcards like '*backup*' match folder names; rules starting 're:' are regexes
+# for the folder path. See NFOScanner.py. season.nfo and tvshow.nfo are always left out.
+excludeDirs = ['.actors']
+
+# How many NFOs to update at once (much faster on network shares; 1 updates them
+# one at a time), the most at once on any one share or drive, and how many times
+# to retry an NFO that fails with a network error. See NFOApply.py.
+applyWorkers = 4
+applyShareLimit = 4
+applyRetries = 3
+
+# Set incrementalRun to 1 to only look at NFOs that are new or have changed since
+# they were last trimmed (or everything, if the filters have changed). The record
+# is kept in infoDir (include trailing \, \\ when escaped; blank for the current
+# folder). Set fullRun to 1, or run with --full, to look at every NFO this time
+# anyway. See RunManifest.py.
+incrementalRun = 1
+fullRun = 0
+infoDir = ""
+
+# Run with --watch to keep running and trim NFOs as they are added or changed
+# (see NFOWatch.py). Changes are collected until there have been none for
+# watchDelay seconds, then done together. Set watchPolling to 1 to check for
+# changes by scanning the folder every watchPollInterval seconds instead of
+# being told of them (best for network shares; used anyway without the
+# watchdog package).
+watchDelay = 5
+watchPolling = 0
+watchPollInterval = 60
+
+# backupMode 'store' saves the originals of the NFOs changed in one compressed
+# backup file per run in infoDir, which BackupStore.py can put back; 'bak' makes
+# a .bak copy next to each NFO instead, and 'none' keeps no backups.
+backupMode = 'store'
+
+# Set setLockdata to 1 to set <lockdata>true</lockdata> in every NFO trimmed (so
+# the media server doesn't change the title back), or 0 to leave it as it is.
+setLockdata = 1
+
+# Set collectMetrics to 1 to time each step of the run (scan, apply) and save the
+# figures to infoDir, and profilePhase to a step to profile as well, eg 'apply'
+# ('' for none; slows it down). See RunMetrics.py.
+collectMetrics = 1
+profilePhase = ''
+
 # Options below are strings or regex patterns. fileFilters are used to exclude.
 # Use case example: For 2015 Home Videos - The Wedding (480p).nfo: The
 # fileFilters 'Home Videos - ' and '( [0-9]+p)' could be used to
@@ -54,47 +106,111 @@ fileFilter2 = ''
 fileFilter3 = ''
 appendTerm = ''
 # More convoluted edits (such as swapping parts around) would be possible with some
-# edits to the function makeNFOTrimList. The variable newname becomes the new filename.
+# edits to the function trimmedName in NFOTransform.py. Its newname becomes the new title.
+# To trim titles while fixing NFOs from a CSV, set trimTitles in FixFromDB.py instead
+# and both are done in one pass.
 
 # ###################################################
 
 nfoData = []
+manifest = None
+nfoCache = NFOCache.openCache()
+backupStore = None
+backupWith = False
+editor = None
+metrics = None
+runSummary = {}
+
+# Populate nfoData with filename and full path of each NFO to trim.
 
-# Populate nfoData with filename, full path, and cleansed matching term(s).
-
-def makeNFOTrimList(filepath, filetype):
-   for root, dirs, files in os.walk(filepath):
-      #traverse directories and get files
-      for file in files:
-         # if file is an nfo, add name and full path to list
-         if file.lower().endswith(filetype.lower()):
-            newname = str(file)
-            if (newname == "season.nfo") or (newname == "tvshow.nfo"):
-                continue
-            newname = re.sub(fileFilter1, '', newname)
-            newname = re.sub(fileFilter2, '', newname)
-            newname = re.sub(fileFilter3, '', newname)
-            newname = newname.replace('.nfo', '')
-            newname = newname + appendTerm
-            nfoData.append({"filename": file, "root": root, "path": os.path.join(root, file), "newname": newname})
+# nfos: NFOScanner records to use instead of scanning filepath (for watch mode).
+
+def makeNFOTrimList(filepath, filetype, nfos=None):
+   #traverse directories and get nfo files (see NFOScanner.py)
+   if nfos is None:
+      nfos = NFOScanner.scanNFOs(filepath, filetype, excludeDirs)
+   for nfo in nfos:
+      if (manifest is not None) and RunManifest.isUnchanged(manifest, nfo):
+         continue
+      nfoData.append({"filename": nfo['filename'], "root": nfo['root'], "path": nfo['path'], "size": nfo['size'], "mtime": nfo['mtime']})
    return
 
-makeNFOTrimList(showroot, '.nfo')
+# Execute file changes: the title from the filename, then lockdata (see
+# NFOTransform.py). Only the title and lockdata are rewritten (see
+# NFOPatch.py); NFOs that already have the right values are left alone and
+# not backed up. Several NFOs are updated at once (see NFOApply.py).
 
-# Execute file changes
+def makeTransforms():
+   transforms = [NFOTransform.trimTitle([fileFilter1, fileFilter2, fileFilter3], appendTerm)]
+   if setLockdata == 1:
+      transforms.append(NFOTransform.lockData)
+   return transforms
 
 def nfoTrim(db):
-   for ea in db:
-      #back up nfo
-      original = str(ea['path'])
-      target = str(ea['path']) + '.bak'
-      shutil.copyfile(original, target)
-      mytree = ET.parse(ea['path'])
-      myroot = mytree.getroot()
-      for tag in myroot.iter('title'):
-         tag.text = ea['newname']
-      for tag in myroot.iter('lockdata'):
-         tag.text = 'true'
-      mytree.write(ea['path'])
-
-nfoTrim(nfoData)
+   report = NFOTransform.applyAll(editor, db, applyWorkers, applyShareLimit, applyRetries)
+   RunMetrics.count(metrics, 'apply', len(db))
+   runSummary.update({'matched': len(db), 'updated': report['counts'].get(True, 0), 'unchanged': report['counts'].get(False, 0),
+                      'failed': len(report['errors'])})
+
+# ################ RUN THE SCRIPT ###############
+# The steps only run when this file is run as a script, so BatchRun.py can
+# load it and change the user variables first (see configure).
+
+def configure(settings):
+   for name, value in settings.items():
+      if name not in globals():
+         raise ValueError("Unknown setting '" + name + "', please check the name and try again.")
+      globals().update({name: value})
+
+# Watch mode (--watch): trim each batch of new or changed NFOs.
+
+def watchTrim():
+   def handleBatch(nfos):
+      nfoData.clear()
+      with RunMetrics.phase(metrics, 'scan'):
+         makeNFOTrimList(showroot, '.nfo', nfos)
+      RunMetrics.count(metrics, 'scan', len(nfoData))
+      with RunMetrics.phase(metrics, 'apply'):
+         nfoTrim(nfoData)
+      if manifest is not None:
+         RunManifest.saveManifest(manifest)
+
+   # each NFO is noted as it's done, so the watcher can tell our writes apart
+   handled = {}
+   editor.update({'written': handled})
+   NFOWatch.watchFolder(showroot, '.nfo', excludeDirs, handleBatch, watchDelay, watchPollInterval, watchPolling, handled)
+
+# Run the script. argv holds any options (--full, --watch). Returns runSummary.
+
+def main(argv):
+   global manifest, backupStore, backupWith, editor, metrics, fullRun
+   if collectMetrics == 1:
+      metrics = RunMetrics.openMetrics('TrimTitle', infoDir, profilePhase)
+   if incrementalRun == 1:
+      if '--full' in argv:
+         fullRun = 1
+      mySettings = {'excludeDirs': excludeDirs, 'fileFilters': [fileFilter1, fileFilter2, fileFilter3], 'appendTerm': appendTerm,
+                    'setLockdata': setLockdata}
+      manifest = RunManifest.openManifest(infoDir, 'TrimTitle', '', RunManifest.configVersion(mySettings), fullRun)
+   backupStore = BackupStore.openStore(infoDir, 'TrimTitle')
+   backupWith = BackupStore.backupMethod(backupMode, backupStore)
+   editor = NFOTransform.openEngine(makeTransforms(), nfoCache, backupWith, None, manifest)
+
+   if '--watch' in argv:
+      watchTrim()
+   else:
+      with RunMetrics.phase(metrics, 'scan'):
+         makeNFOTrimList(showroot, '.nfo')
+      RunMetrics.count(metrics, 'scan', len(nfoData))
+      with RunMetrics.phase(metrics, 'apply'):
+         nfoTrim(nfoData)
+
+   if manifest is not None:
+      runSummary.update({'unchangedSinceLastRun': manifest['skipped']})
+      RunManifest.closeManifest(manifest)
+   BackupStore.closeStore(backupStore)
+   RunMetrics.saveMetrics(metrics, runSummary)
+   return runSummary
+
+if __name__ == '__main__':
+   main(sys.argv)
@@ -6,7 +6,9 @@
 # DEPENDENCIES
 # The script is written in python and tested in v3.12.8.
 # Imports are as follows:
-# os, sys, xml.etree, fuzzywuzzy, re, csv, shutil, datetime
+# os, sys, re, csv, shutil, datetime, math
+# FixFromDB also uses rapidfuzz (or fuzzywuzzy) and numpy for fuzzy matching.
+# Watch mode (--watch) uses watchdog if it is installed.
 #
 # TOOLS:
 #
@@ -29,14 +31,51 @@
 # is not desired to rename the underlying file. Substituting the title in the
 # corresponding NFO (and directing the media server to update from NFOs) will
 # alter the GUI display name without affecting the underlying file.
-# A backup of the original NFO file is also created (filename.bak).
+# The original NFO is backed up first (see BackupStore.py).
 #
 # The scripts are heavily commented to allow for further customisation.
+#
+# RUNNING FROM HERE (OR FROM OTHER CODE)
+# Either script can be run from here without editing it, with any user
+# variables given as name=value:
+#
+#   python main.py FixFromDB showroot="c:\tv\Show" dataFile="c:\data\show.csv" searchMethod=2
+#   python main.py TrimTitle showroot="c:\videos" fileFilter1="Home Videos - "
+#
+# Values are read as Python values where they can be (2, 'triage', [1, 2]),
+# and as text otherwise. A summary of the run is printed at the end as JSON.
+# This runs one job with a Session (see NFOSession.py), the same as other
+# Python code can do to run many jobs without loading the CSV or catalog each
+# time. reviewMode 'triage' still asks about the fuzzy matches it isn't sure
+# of; use reviewMode=auto to run without anyone there.
+
+import ast
+import sys
+import json
+import NFOSession
+
+def readSettings(args):
+    settings = {}
+    for arg in args:
+        name, separator, value = arg.partition('=')
+        if separator == '':
+            raise ValueError("Settings are given as name=value, not '" + arg + "'.")
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        settings.update({name: value})
+    return settings
 
-def main():
-    print("\nMain function not currently used. Reserved for future GUI.")
-    print("Refer to script comments for usage guidance and execute the desired script direct.")
-    print("You will need to manually edit some parameters before the scripts will work.")
+def main(argv):
+    if len(argv) < 2:
+        print("\nUsage: python main.py <FixFromDB|TrimTitle> [name=value ...]")
+        print("Refer to script comments for usage guidance and the user variables that can be set.")
+        return None
+    with NFOSession.Session(argv[1], readSettings(argv[2:])) as session:
+        summary = session.run()
+    print(json.dumps(summary, indent=1))
+    return summary
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main(sys.argv)
\ No newline at end of file